@@ -13,11 +13,14 @@ class JsonRpcClient
     private $socket = null;
     private $host = null;
     private $port = null;
+    private $socketPath = null;
     private $prefix = '';
     private $debug = false;
     private $connected = false;
     private $reconnect = false;
     private $timeout = 1; // seconds, integer
+    private $sendTimeout = false; // send the timeout with every request
+    private $framing = 'json'; // 'json' or 'netstring'
 
     // -----
 
@@ -26,11 +29,14 @@ class JsonRpcClient
         $this->socket = NULL;
         $this->host = null;
         $this->port = null;
+        $this->socketPath = null;
         $this->prefix = '';
         $this->debug = false;
         $this->connected = false;
         $this->reconnect = false;
         $this->timeout = 1;
+        $this->sendTimeout = false;
+        $this->framing = 'json';
     }
 
     public function __destruct()
@@ -43,7 +49,8 @@ class JsonRpcClient
 
     /**
      * Connects the client to the server.
-     * Requires that at the very least the host and port are set by calling setHost() and setPort().
+     * Requires that at the very least the host and port are set by calling setHost() and setPort(),
+     * or the path of a Unix domain socket by calling setSocketPath() (for a server on the same host).
      * The socket is set to timeout on read and write. The timeout period defaults to 1 second and can be
      * controlled by calling setTimeout() before calling connect().
      * @throw JsonConnException when the host and port are not defined or when the connection setup failed.
@@ -52,12 +59,14 @@ class JsonRpcClient
     public function connect()
     {
         if (!$this->socket) {
-            if ($this->host === null || $this->port === null) {
+            if ($this->socketPath !== null) {
+                $this->socket = socket_create(AF_UNIX, SOCK_STREAM, 0);
+            } elseif ($this->host === null || $this->port === null) {
                 throw new JsonConnException("Port or host not provided");
+            } else {
+                $this->socket = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
             }
 
-            $this->socket = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
-
             if (!$this->socket) {
                 throw new JsonConnException(socket_strerror(socket_last_error()));
             }
@@ -70,7 +79,12 @@ class JsonRpcClient
                 throw new JsonOptException(socket_strerror(socket_last_error()));
             }
 
-            if (!socket_connect($this->socket, $this->getHost(), $this->getPort())) {
+            if ($this->socketPath !== null) {
+                $connected = socket_connect($this->socket, $this->socketPath);
+            } else {
+                $connected = socket_connect($this->socket, $this->getHost(), $this->getPort());
+            }
+            if (!$connected) {
                 throw new JsonConnException(socket_strerror(socket_last_error()));
             }
         }
@@ -148,7 +162,7 @@ class JsonRpcClient
         return str_replace('\\\\', '\\', $string);
     }
 
-    // This function counts the curly brackets in the input string, and will return true if they match.
+    // This function counts the curly and square brackets in the input string, and will return true if they match.
     private function checkJsonStream($str)
     {
         $curlybracketcounter = 0;
@@ -164,16 +178,32 @@ class JsonRpcClient
                     $singleqoute = !$singleqoute;
 
             if ($doubleqoute && $singleqoute) {
-                if ($str[$i] == '{')
+                if ($str[$i] == '{' || $str[$i] == '[')
                     $curlybracketcounter++;
 
-                if ($str[$i] == '}')
+                if ($str[$i] == '}' || $str[$i] == ']')
                     $curlybracketcounter--;
             }
         }
         return ($curlybracketcounter == 0);
     }
 
+    /**
+     * Encodes a single rpc request.
+     * @param string $name  The name of the remote function
+     * @param mixed $params function parameters, scalar, array or hash
+     * @param int $id request id
+     * @return string the json encoded request
+     */
+    private function encodeRequest($name, $params, $id)
+    {
+        $result = $this->_json_encode($params);
+
+        $result = $result == '""' ? "" : $result;
+        $timeout = $this->isSendTimeout() ? ', "timeout": ' . $this->getTimeout() : '';
+        return '{"method": "' . $this->getPrefix() . $name . '", "params": ' . $result . ', "id": ' . $id . $timeout . '}';
+    }
+
     /**
      * Sends the rpc request.
      * @param string $name  The name of the remote function
@@ -184,10 +214,21 @@ class JsonRpcClient
      */
     private function send($name, $params)
     {
-        $result = $this->_json_encode($params);
+        $this->write($this->encodeRequest($name, $params, 0));
+    }
 
-        $result = $result == '""' ? "" : $result;
-        $request = '{"method": "' . $this->getPrefix() . $name . '", "params": ' . $result . ', "id": 0}';
+    /**
+     * Writes an encoded request (or batch of requests) to the socket.
+     * @param string $request the json encoded request
+     * @throws JsonIOException on timeout or other connection error
+     * @throws JsonPartialException when only part of the request is transmitted
+     * @return void
+     */
+    private function write($request)
+    {
+        if ($this->getFraming() == 'netstring') {
+            $request = strlen($request) . ':' . $request . ',';
+        }
 
         if ($this->isDebug()) {
             echo $request . "\n";
@@ -214,6 +255,50 @@ class JsonRpcClient
      * @return mixed hash containing error en result keys
      */
     private function receive()
+    {
+        $result = $this->decodeReply($this->receiveReply());
+
+        // determine the return value, log it and finish
+        return ($result == NULL ?
+            array("error" => NULL, "result" => "-NULL") :
+            array("error" => $result->error, "result" => $result->result));
+    }
+
+    /**
+     * Receives the raw rpc reply using the configured framing.
+     * @throws JsonIOException on timeout or other connection error
+     * @throws JsonEncodingException when the received reply is no valid netstring
+     * @return string the json encoded reply
+     */
+    private function receiveReply()
+    {
+        if ($this->getFraming() == 'netstring') {
+            return $this->receiveNetstring();
+        }
+        return $this->receiveJsonStream();
+    }
+
+    /**
+     * Decodes a json encoded reply.
+     * @param string $reply the json encoded reply
+     * @throws JsonEncodingException when the reply is invalid json encoded
+     * @return mixed the decoded reply
+     */
+    private function decodeReply($reply)
+    {
+        $result = json_decode($reply);
+        if ($result === null && json_last_error() !== JSON_ERROR_NONE) {
+            throw new JsonEncodingException(json_last_error_msg());
+        }
+        return $result;
+    }
+
+    /**
+     * Receives a raw json reply, the reply ends where the curly brackets match.
+     * @throws JsonIOException on timeout or other connection error
+     * @return string the json encoded reply
+     */
+    private function receiveJsonStream()
     {
         $reply = "";
         do {
@@ -232,7 +317,8 @@ class JsonRpcClient
 
             // Check for continue
             $recv = rtrim($recv);
-            if ($recv[strlen($recv) - 1] == "}") {
+            $last = $recv[strlen($recv) - 1];
+            if ($last == "}" || $last == "]") {
                 $continue = !$this->checkJsonStream($reply);
                 
                 // if we have matching brackets and the last buffer returned was a full buffer we
@@ -248,15 +334,66 @@ class JsonRpcClient
             }
         } while (!empty($recv) && $continue);
 
-        $result = json_decode($reply);
-        if ($result === null && json_last_error() !== JSON_ERROR_NONE) {
-            throw new JsonEncodingException(json_last_error_msg());
+        return $reply;
+    }
+
+    /**
+     * Receives a netstring framed reply ("<length>:<json>,").
+     * The length header tells how many bytes to expect, so the reply is read in bulk
+     * without inspecting its content.
+     * @throws JsonIOException on timeout or other connection error
+     * @throws JsonEncodingException when the received reply is no valid netstring
+     * @return string the json encoded reply
+     */
+    private function receiveNetstring()
+    {
+        $buffer = "";
+        while (($colon = strpos($buffer, ':')) === false) {
+            if (strlen($buffer) > 10) {
+                throw new JsonEncodingException("Invalid netstring length");
+            }
+            $buffer .= $this->receiveBytes(1024 - strlen($buffer), 0);
         }
 
-        // determine the return value, log it and finish
-        return ($result == NULL ?
-            array("error" => NULL, "result" => "-NULL") :
-            array("error" => $result->error, "result" => $result->result));
+        $length = substr($buffer, 0, $colon);
+        if (!ctype_digit($length)) {
+            throw new JsonEncodingException("Invalid netstring length");
+        }
+
+        // reply and the trailing comma
+        $reply = substr($buffer, $colon + 1);
+        $missing = (int)$length + 1 - strlen($reply);
+        if ($missing > 0) {
+            $reply .= $this->receiveBytes($missing, MSG_WAITALL);
+        }
+
+        if (strlen($reply) != (int)$length + 1 || substr($reply, -1) != ',') {
+            throw new JsonEncodingException("Netstring not terminated by ','");
+        }
+        return substr($reply, 0, -1);
+    }
+
+    /**
+     * Reads up to $length bytes from the socket.
+     * @param int $length maximum number of bytes to read
+     * @param int $flags socket_recv flags
+     * @throws JsonIOException on timeout, connection error or a closed connection
+     * @return string the received bytes
+     */
+    private function receiveBytes($length, $flags)
+    {
+        $result = socket_recv($this->socket, $recv, $length, $flags);
+        if ($result === false) {
+            throw new JsonIOException(socket_strerror(socket_last_error()));
+        }
+        if ($result === 0) {
+            throw new JsonIOException("Connection closed by server");
+        }
+
+        if ($this->isDebug()) {
+            echo 'Received(' . strlen($recv) . '=' . $result . ') -> [' . $recv . "]\n";
+        }
+        return $recv;
     }
 
     /**
@@ -289,6 +426,59 @@ class JsonRpcClient
         return $return;
     }
 
+    /**
+     * Calls several remote procedures in a single round-trip (batch request).
+     * Called as $object->batch(array(array('FnName', array(arg1, arg2)), array('OtherFn')))
+     * @param array $calls list of calls, each an array of the function name and optionally
+     * its arguments. The function name prefix is added to every name.
+     * @throws JsonIOException on timeout or other connection error
+     * @throws JsonPartialException when only part of the request is transmitted
+     * @throws JsonEncodingException when the received reply is invalid json encoded
+     * @return array hashes containing error en result keys, with the keys of $calls.
+     * When the server rejects the whole batch its error is returned for every call.
+     */
+    public function batch($calls)
+    {
+        if ($this->isReconnect()) {
+            $this->connect();
+        }
+
+        if (!$this->isConnected()) {
+            throw new JsonConnException('RPC client is not yet connected, try $object->connect();');
+        }
+
+        $keys = array_keys($calls);
+        $requests = array();
+        foreach ($keys as $id => $key) {
+            $call = $calls[$key];
+            $params = isset($call[1]) ? $call[1] : array();
+            $requests[] = $this->encodeRequest($call[0], $params, $id);
+        }
+        $this->write('[' . implode(', ', $requests) . ']');
+        $replies = $this->decodeReply($this->receiveReply());
+
+        $return = array();
+        if (is_array($replies)) {
+            foreach ($keys as $key) {
+                $return[$key] = array("error" => NULL, "result" => "-NULL");
+            }
+            foreach ($replies as $reply) {
+                if (isset($reply->id) && isset($keys[$reply->id])) {
+                    $return[$keys[$reply->id]] = array("error" => $reply->error, "result" => $reply->result);
+                }
+            }
+        } else {
+            foreach ($keys as $key) {
+                $return[$key] = array("error" => $replies->error, "result" => $replies->result);
+            }
+        }
+
+        if ($this->isReconnect()) {
+            $this->disconnect();
+        }
+        return $return;
+    }
+
     // Private Setters
     private function setConnected($connected)
     {
@@ -336,6 +526,28 @@ class JsonRpcClient
         return $this;
     }
 
+    /**
+     * Returns the path of the Unix domain socket to which the client connects.
+     * @return string|null The socket path, null when connecting over TCP.
+     */
+    public function getSocketPath()
+    {
+        return $this->socketPath;
+    }
+
+    /**
+     * Sets the path of the Unix domain socket to which the client will connect.
+     * When set, the host and port are not used. Use this for a server on the same
+     * host, it skips the TCP stack.
+     * @param string|null $socketPath The socket path, null to connect over TCP.
+     * @return JsonRpcClient Support the fluent interface.
+     */
+    public function setSocketPath($socketPath)
+    {
+        $this->socketPath = $socketPath === null ? null : (string)$socketPath;
+        return $this;
+    }
+
     /**
      * Returns the function name prefix for the api.
      * @return string The function name prefix.
@@ -430,6 +642,56 @@ class JsonRpcClient
         $this->timeout = $timeout;
         return $this;
     }
+
+    /**
+     * Is the timeout sent with every request?
+     * @return bool True when the timeout is sent.
+     */
+    public function isSendTimeout()
+    {
+        return $this->sendTimeout;
+    }
+
+    /**
+     * Sets whether the timeout is sent with every request ("timeout" field).
+     * The server then drops a request it could not start before the client gives up,
+     * and cancels its execution where possible, instead of sending the reply to a
+     * closed socket. The server must support the "timeout" field.
+     * @param bool $sendTimeout
+     * @return JsonRpcClient Support the fluent interface.
+     */
+    public function setSendTimeout($sendTimeout)
+    {
+        $this->sendTimeout = (bool)$sendTimeout;
+        return $this;
+    }
+
+    /**
+     * Get the message framing.
+     * @return string 'json' or 'netstring'.
+     */
+    public function getFraming()
+    {
+        return $this->framing;
+    }
+
+    /**
+     * Sets the message framing.
+     * 'json' (default) sends and receives raw json messages, 'netstring' prefixes every
+     * message with its length ("<length>:<json>,") so replies are read in bulk.
+     * The server must support netstring framing.
+     * @param string $framing 'json' or 'netstring'
+     * @throws JsonRpcException when the framing is unknown
+     * @return JsonRpcClient Support the fluent interface.
+     */
+    public function setFraming($framing)
+    {
+        if ($framing !== 'json' && $framing !== 'netstring') {
+            throw new JsonRpcException("Unknown framing: " . $framing);
+        }
+        $this->framing = $framing;
+        return $this;
+    }
 }
 
 ?>
@@ -1,5 +1,40 @@
 #!/usr/bin/python
 
+import time
+import threading
+import jsonrpc
+
 class apiTest:
     def Test(self, x, y):
-        return x + y
\ No newline at end of file
+        return x + y
+
+    def Sleep(self, seconds):
+        """Return seconds after seconds, without blocking the server."""
+        result = jsonrpc.AsyncResult()
+        timer = threading.Timer(seconds, result.set_result, [seconds])
+        result.add_cancel_callback(lambda r: timer.cancel())
+        timer.start()
+        return result
+
+    def Primes(self, limit):
+        """Number of primes below limit (CPU-bound)."""
+        count = 0
+        for n in xrange(2, limit):
+            if n % 10000 == 0:
+                jsonrpc.check_deadline()
+            for d in xrange(2, int(n ** 0.5) + 1):
+                if n % d == 0:
+                    break
+            else:
+                count += 1
+        return count
+
+    def Export(self, count):
+        """Generate count records, the result is streamed."""
+        for i in xrange(count):
+            yield {"id": i, "name": "customer %d" % i, "active": i % 2 == 0}
+
+    def Lookup(self, key):
+        """Slow lookup in a (simulated) data store."""
+        time.sleep(0.01)
+        return {"key": key, "value": key.upper()}
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+"""
+Event-loop JSON-RPC server engine (asyncore).
+
+All connections are served by a single thread. RPC-functions returning a
+jsonrpc.AsyncResult do not block the loop: the loop continues serving other
+clients and the reply is sent as soon as the result is set, which may
+happen from any thread.
+
+Optionally the requests are executed by a jsonrpc.WorkerPool, the loop then
+only does the I/O. Requests which do not fit in the queue of the pool (or
+are shed by it) are rejected at once with a SERVER_BUSY error, requests
+which waited in the queue beyond their deadline are answered with a
+REQUEST_TIMEOUT error without executing them.
+"""
+
+import asyncore
+import collections
+import errno
+import fcntl
+import os
+import socket
+import sys
+import time
+
+import jsonrpc
+import unixserver
+from jsonrpc import RPCFault
+
+
+class Waker(asyncore.file_dispatcher):
+    """Runs callbacks from other threads in the event loop.
+
+    The loop is woken up by writing to a pipe.
+    """
+    def __init__(self, map):
+        r, self._w = os.pipe()
+        fcntl.fcntl(self._w, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, r, map)
+        os.close(r)         # file_dispatcher uses a dup
+        self.pending = collections.deque()
+
+    def call(self, function, *args):
+        """Call function(*args) in the event loop thread."""
+        self.pending.append((function, args))
+        try:
+            os.write(self._w, "x")
+        except OSError, err:
+            if err.errno != errno.EAGAIN:   # pipe full, loop is awake anyway
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        while self.pending:
+            function, args = self.pending.popleft()
+            function(*args)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._w)
+
+
+class AsyncConnection(asyncore.dispatcher):
+    """A (keep-alive) client connection of an AsyncServer."""
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map = server.map)
+        self.server = server
+        self.decoder = jsonrpc.FRAMINGS[server.framing](server.max_frame_size)
+        self.outbuf = bytearray()
+        self.stream = None          # chunks of the StreamedReply being sent
+        self.queue = collections.deque()    # replies waiting for the stream
+        self.last_active = time.time()
+        self.pending = 0            # AsyncResults waiting for completion
+        self.closing = False
+
+    def handle_read(self):
+        data = self.recv(self.server.recv_size)
+        if not data:
+            return
+        self.last_active = time.time()
+
+        try:
+            frames = self.decoder.feed(data)
+        except RPCFault, err:
+            # the stream can not be resynchronized, answer and hang up
+            self.server.logfile("Invalid stream: %s" % str(err))
+            self.push(self.server.dispatcher.data_serializer.dumps_error(err, id = None))
+            self.closing = True
+            return
+
+        for data in frames:
+            self.server.dispatcher.log_payload("Request: ", data)
+            if self.server.pool is None:
+                reply = self.server.dispatcher.dispatch(data, callback = self.async_reply)
+                if isinstance(reply, jsonrpc.AsyncResult):
+                    self.pending += 1
+                elif reply is not None:
+                    self.push(reply)
+            else:
+                try:
+                    self.server.pool.submit(self.dispatch_job, data, self.last_active)
+                    self.pending += 1
+                except RPCFault, err:
+                    self.push(self.server.dispatcher.error_reply(data, err))
+
+    def dispatch_job(self, data, received):
+        """Dispatch a request in a thread of the pool.
+
+        :Parameters:
+            - received: time.time() when the request was received, the
+                        deadline of the request counts from here
+        """
+        reply = self.server.dispatcher.dispatch(data, callback = self.async_reply, received = received)
+        if not isinstance(reply, jsonrpc.AsyncResult):
+            self.async_reply(reply)
+
+    def async_reply(self, reply):
+        """Reply of an AsyncResult or pool job, called from the completing thread."""
+        self.server.waker.call(self._async_done, reply)
+
+    def _async_done(self, reply):
+        self.pending -= 1
+        self.last_active = time.time()
+        if reply is not None and self.connected:
+            self.push(reply)
+
+    def push(self, reply):
+        """Queue a reply (a string or a jsonrpc.StreamedReply) for sending.
+
+        None sends nothing. Replies pushed while a StreamedReply is sent
+        wait until it is complete.
+        """
+        if reply is None:
+            return
+        self.server.dispatcher.log_reply(reply)
+        if self.stream is not None or self.queue:
+            self.queue.append(reply)
+        elif isinstance(reply, jsonrpc.StreamedReply):
+            self.stream = iter(self.decoder.encode_stream(reply))
+        else:
+            self.outbuf += self.decoder.encode(reply)
+        self.handle_write()
+
+    def fill(self):
+        """Move chunks of the streamed reply and the queued replies to outbuf.
+
+        At most stream_buffer bytes are buffered, the next chunks are
+        produced when the socket is writable again.
+        """
+        while len(self.outbuf) < self.server.stream_buffer:
+            if self.stream is not None:
+                try:
+                    self.outbuf += next(self.stream)
+                    continue
+                except StopIteration:
+                    self.stream = None
+            if not self.queue:
+                break
+            reply = self.queue.popleft()
+            if isinstance(reply, jsonrpc.StreamedReply):
+                self.stream = iter(self.decoder.encode_stream(reply))
+            else:
+                self.outbuf += self.decoder.encode(reply)
+
+    def writable(self):
+        return bool(self.outbuf) or self.stream is not None or bool(self.queue) or self.closing
+
+    def handle_write(self):
+        if self.stream is not None or self.queue:
+            self.fill()
+        if self.outbuf:
+            sent = self.send(self.outbuf)
+            if sent:
+                del self.outbuf[:sent]
+                self.last_active = time.time()
+        if self.closing and not self.outbuf and self.stream is None and not self.queue:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.dispatcher.log_exception(sys.exc_info())
+        self.close()
+
+    def is_idle(self, now):
+        """True if the connection has nothing to do since idle_timeout."""
+        return (not self.pending and not self.outbuf and self.stream is None and not self.queue and
+                now - self.last_active > self.server.idle_timeout)
+
+
+class AsyncServer(asyncore.dispatcher):
+    """JSON-RPC server serving all connections from one event loop.
+
+    Connections are polled with poll(2), so the number of connections is
+    not limited by FD_SETSIZE.
+    """
+
+    # seconds an idle keep-alive connection is kept open
+    idle_timeout = 30
+    # size of a single socket read
+    recv_size = 65536
+    # maximum size of a request in bytes, None for unlimited
+    max_frame_size = 16 * 1024 * 1024
+    # message framing: "auto" (negotiated by the client), "json" or "netstring"
+    framing = "auto"
+    # listen backlog
+    request_queue_size = 1024
+    # bytes of streamed replies buffered per connection
+    stream_buffer = 256 * 1024
+    # permissions of a Unix domain socket file, None for unixserver.SOCKET_MODE
+    socket_mode = None
+
+    def __init__(self, server_address, dispatcher, pool = None):
+        """init
+
+        :Parameters:
+            - server_address: (host, port) to listen on, or the path of a
+                              Unix domain socket
+            - dispatcher:     the jsonrpc.Dispatcher handling the requests
+            - pool:           jsonrpc.WorkerPool executing the requests,
+                              if omitted they are executed by the loop
+        """
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map = self.map)
+        self.dispatcher = dispatcher
+        self.pool = pool
+        if unixserver.is_unix_address(server_address):
+            sock = unixserver.listen(server_address, self.request_queue_size, self.socket_mode)
+            sock.setblocking(0)
+            self.set_socket(sock, self.map)
+            self.accepting = True
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(server_address)
+            self.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.waker = Waker(self.map)
+        self._running = False
+
+    def logfile(self, message):
+        self.dispatcher.logfile(message)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            AsyncConnection(pair[0], self)
+
+    def close_idle(self):
+        """Close keep-alive connections idle for more than idle_timeout."""
+        now = time.time()
+        for channel in self.map.values():
+            if isinstance(channel, AsyncConnection) and channel.is_idle(now):
+                channel.close()
+
+    def serve_forever(self, poll_interval = 1.0):
+        """Run the event loop until shutdown() is called."""
+        self._running = True
+        last_sweep = time.time()
+        while self._running:
+            asyncore.loop(timeout = poll_interval, use_poll = True, map = self.map, count = 1)
+            if time.time() - last_sweep >= poll_interval:
+                self.close_idle()
+                last_sweep = time.time()
+
+    def shutdown(self):
+        """Stop serve_forever() and close all connections."""
+        self._running = False
+        asyncore.close_all(self.map)
+        if unixserver.is_unix_address(self.server_address):
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+        if self.pool is not None:
+            self.pool.shutdown()
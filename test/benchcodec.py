@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark of the json codecs used by jsonrpc.JsonRpc10.
+
+Times dumps_response and loads_request with every available codec for a
+small and a large payload, to check that jsonrpc.CODEC_PREFERENCE (the
+codec picked by default) is still the fastest.
+
+The ujson codec hands integers beyond 64 bits, byte strings which are no
+valid UTF-8 and invalid json to json (see jsonrpc.CODEC_PREFERENCE); the
+payloads here measure the common case only.
+
+Usage: benchcodec.py [-n NUMBER]
+"""
+
+import optparse
+import timeit
+
+import jsonrpc
+
+PAYLOADS = {
+    "small" : [7, 8],
+    "large" : [{"id": i, "name": "customer %d" % i, "active": i % 2 == 0,
+                "balance": i * 1.25, "tags": ["a", "b", "c"]} for i in range(1000)],
+}
+
+
+def bench(codec, payload, number):
+    """Return the seconds per call of dumps_response and loads_request."""
+    serializer = jsonrpc.JsonRpc10(codec = codec)
+    request = serializer.dumps_request("test.Test", payload, 1)
+
+    dumps = timeit.Timer(lambda: serializer.dumps_response(payload, 1)).timeit(number)
+    loads = timeit.Timer(lambda: serializer.loads_request(request)).timeit(number)
+    return dumps / number, loads / number
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--number", type = "int", default = 20000,
+                      help = "calls per measurement of the small payload [%default]")
+    options, args = parser.parse_args()
+
+    print "default codec: %s" % jsonrpc.get_codec().name
+    print "%-10s %-6s %16s %16s" % ("codec", "size", "dumps_response", "loads_request")
+    for size in ("small", "large"):
+        number = options.number if size == "small" else max(1, options.number / 1000)
+        fastest = None
+        for name in jsonrpc.CODEC_PREFERENCE:
+            if name not in jsonrpc.CODECS:
+                continue
+            dumps, loads = bench(jsonrpc.CODECS[name], PAYLOADS[size], number)
+            print "%-10s %-6s %13.2f us %13.2f us" % (name, size, dumps * 1e6, loads * 1e6)
+            if fastest is None or dumps + loads < fastest[1]:
+                fastest = (name, dumps + loads)
+        if fastest[0] != jsonrpc.get_codec().name:
+            print "WARNING: %s is faster than the default codec for %s payloads" % (fastest[0], size)
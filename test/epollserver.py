@@ -0,0 +1,454 @@
+#!/usr/bin/python
+
+"""
+Event-loop JSON-RPC server engine for many mostly idle connections (epoll).
+
+Persistent clients (e.g. the PHP-FPM workers of many hosts) keep their
+connections open, but most of the time they are idle. A thread or
+process per connection wastes memory on them, and asyncore polls all
+connections in every iteration. This server registers every connection
+once with epoll(7) (poll(2) where epoll is not available) and only
+touches the ready ones, so a single thread multiplexes tens of thousands
+of connections:
+
+    - an idle connection only holds its socket and a small slotted
+      object; all reads share one buffer, frame decoder and output
+      buffer are created when needed
+    - connections idle for more than idle_timeout are closed, the
+      connections are kept ordered by activity so the sweep only looks at
+      the expired ones
+    - at most max_connections are open, further connections are closed
+      right after accepting them
+
+The ready requests are executed by a jsonrpc.WorkerPool (or by the loop
+if there is none, for RPC-functions which do not block); replies are
+handed back to the loop and sent from there.
+"""
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import sys
+import time
+
+import jsonrpc
+import unixserver
+from jsonrpc import RPCFault
+
+# the poll(2) constants have the same values
+EVENT_READ = getattr(select, "EPOLLIN", 1)
+EVENT_WRITE = getattr(select, "EPOLLOUT", 4)
+EVENT_ERROR = getattr(select, "EPOLLERR", 8) | getattr(select, "EPOLLHUP", 16)
+
+# socket errors of a connection closed by the client
+_DISCONNECTED = frozenset((errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN, errno.ESHUTDOWN,
+                           errno.ECONNABORTED, errno.ETIMEDOUT))
+
+
+class Poller:
+    """epoll object, or a poll object with the same interface."""
+
+    def __init__(self):
+        self._epoll = getattr(select, "epoll", None)
+        if self._epoll is not None:
+            self._poller = self._epoll()
+        else:
+            self._poller = select.poll()
+        self.register = self._poller.register
+        self.modify = self._poller.modify
+        self.unregister = self._poller.unregister
+
+    def poll(self, timeout):
+        """Return the [(fd, events)] ready within timeout seconds."""
+        try:
+            if self._epoll is not None:
+                return self._poller.poll(timeout)
+            return self._poller.poll(timeout * 1000)
+        except (IOError, OSError, select.error), err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if self._epoll is not None:
+            self._poller.close()
+
+
+class Connection(object):
+    """A (keep-alive) client connection of an EpollServer.
+
+    Slotted, every idle connection costs only a few hundred bytes.
+    """
+    __slots__ = ("sock", "fd", "decoder", "outbuf", "stream", "queue", "last_active",
+                 "pending", "closing", "closed", "writing")
+
+    def __init__(self, sock, now):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.decoder = None         # created with the first data
+        self.outbuf = None          # bytearray of the unsent data
+        self.stream = None          # chunks of the StreamedReply being sent
+        self.queue = None           # replies waiting for the stream
+        self.last_active = now
+        self.pending = 0            # requests in progress
+        self.closing = False        # close when everything is sent
+        self.closed = False
+        self.writing = False        # registered for EVENT_WRITE
+
+    def busy(self):
+        """True if requests are in progress or data is to be sent."""
+        return bool(self.pending or self.outbuf or self.stream is not None or self.queue)
+
+
+class EpollServer:
+    """JSON-RPC server serving all connections from one epoll loop."""
+
+    # seconds an idle keep-alive connection is kept open
+    idle_timeout = 30
+    # maximum number of open connections
+    max_connections = 10000
+    # size of a single socket read
+    recv_size = 65536
+    # maximum size of a request in bytes, None for unlimited
+    max_frame_size = 16 * 1024 * 1024
+    # message framing: "auto" (negotiated by the client), "json" or "netstring"
+    framing = "auto"
+    # listen backlog
+    request_queue_size = 1024
+    # bytes of streamed replies buffered per connection
+    stream_buffer = 256 * 1024
+    # permissions of a Unix domain socket file, None for unixserver.SOCKET_MODE
+    socket_mode = None
+    # seconds to wait for the requests in the pool on shutdown
+    shutdown_timeout = 5
+
+    def __init__(self, server_address, dispatcher, pool = None):
+        """init
+
+        :Parameters:
+            - server_address: (host, port) to listen on, or the path of a
+                              Unix domain socket
+            - dispatcher:     the jsonrpc.Dispatcher handling the requests
+            - pool:           jsonrpc.WorkerPool executing the requests,
+                              if omitted they are executed by the loop
+        """
+        self.dispatcher = dispatcher
+        self.pool = pool
+        if unixserver.is_unix_address(server_address):
+            self.socket = unixserver.listen(server_address, self.request_queue_size, self.socket_mode)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.unix = unixserver.is_unix_address(server_address)
+
+        self.poller = Poller()
+        self.poller.register(self.socket.fileno(), EVENT_READ)
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self._wake_r, EVENT_READ)
+        self.completed = collections.deque()    # (connection, reply) from other threads
+
+        # fd -> Connection, least recently active first
+        self.connections = collections.OrderedDict()
+        self._buffer = bytearray(self.recv_size)
+        self._view = memoryview(self._buffer)
+        self._running = False
+        self._closed = False
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def logfile(self, message):
+        self.dispatcher.logfile(message)
+
+    def stats(self):
+        """Return a dict with the open, accepted, rejected and timed out connections."""
+        return {"connections": len(self.connections), "max_connections": self.max_connections,
+                "accepted": self.accepted, "rejected": self.rejected, "idle_timeouts": self.timeouts}
+
+    #----------------------
+    # event loop
+
+    def serve_forever(self, poll_interval = 1.0):
+        """Run the event loop until shutdown() is called."""
+        self._running = True
+        listen_fd = self.socket.fileno()
+        last_sweep = time.time()
+        try:
+            while self._running:
+                for fd, events in self.poller.poll(poll_interval):
+                    if fd == listen_fd:
+                        self.handle_accept()
+                    elif fd == self._wake_r:
+                        self.handle_completed()
+                    else:
+                        connection = self.connections.get(fd)
+                        if connection is None:
+                            continue
+                        try:
+                            if events & (EVENT_READ | EVENT_ERROR):
+                                self.handle_read(connection)
+                            if events & EVENT_WRITE and not connection.closed:
+                                self.handle_write(connection)
+                        except Exception:
+                            self.dispatcher.log_exception(sys.exc_info())
+                            self.close(connection)
+                now = time.time()
+                if now - last_sweep >= poll_interval:
+                    self.close_idle(now)
+                    last_sweep = now
+        finally:
+            self._running = False
+            self.server_close()
+
+    def shutdown(self):
+        """Stop serve_forever(), which closes all connections."""
+        if self._running:
+            self._running = False
+            self._wakeup()
+
+    def server_close(self):
+        """Close the connections, the listening socket and the pool."""
+        if self._closed:
+            return
+        self._closed = True
+        for connection in self.connections.values():
+            self.close(connection)
+        self.poller.close()
+        self.socket.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        if self.unix:
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+        if self.pool is not None:
+            # the workers must not outlive the interpreter
+            self.pool.shutdown(self.shutdown_timeout)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError, err:
+            if err.errno != errno.EAGAIN:   # pipe full, loop is awake anyway
+                raise
+
+    #----------------------
+    # connections
+
+    def handle_accept(self):
+        """Accept the waiting connections, close those beyond max_connections."""
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED, errno.EINTR):
+                    return
+                if err.args[0] in (errno.EMFILE, errno.ENFILE):
+                    self.logfile("Accept failed: %s" % err)
+                    return
+                raise
+            if len(self.connections) >= self.max_connections:
+                self.rejected += 1
+                sock.close()
+                continue
+            sock.setblocking(0)
+            if not self.unix:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(sock, time.time())
+            self.connections[connection.fd] = connection
+            self.poller.register(connection.fd, EVENT_READ)
+            self.accepted += 1
+
+    def touch(self, connection, now):
+        """Mark connection as active, it moves to the end of the idle order."""
+        connection.last_active = now
+        del self.connections[connection.fd]
+        self.connections[connection.fd] = connection
+
+    def close_idle(self, now):
+        """Close the keep-alive connections idle for more than idle_timeout."""
+        connections = self.connections
+        while connections:
+            connection = connections[next(iter(connections))]
+            if now - connection.last_active <= self.idle_timeout:
+                break
+            if connection.busy():
+                self.touch(connection, now)
+                continue
+            self.timeouts += 1
+            self.close(connection)
+
+    def close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.pop(connection.fd, None)
+        try:
+            self.poller.unregister(connection.fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        connection.sock.close()
+        connection.outbuf = connection.stream = connection.queue = None
+
+    def handle_read(self, connection):
+        try:
+            n = connection.sock.recv_into(self._buffer)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            if err.args[0] in _DISCONNECTED:
+                self.close(connection)
+                return
+            raise
+        if not n:               # closed by client
+            self.close(connection)
+            return
+        now = time.time()
+        self.touch(connection, now)
+        if connection.closing:
+            return
+
+        if connection.decoder is None:
+            connection.decoder = jsonrpc.FRAMINGS[self.framing](self.max_frame_size)
+        try:
+            frames = connection.decoder.feed(self._view[:n])
+        except RPCFault, err:
+            # the stream can not be resynchronized, answer and hang up
+            self.logfile("Invalid stream: %s" % str(err))
+            self.push(connection, self.dispatcher.data_serializer.dumps_error(err, id = None))
+            connection.closing = True
+            self.update(connection)
+            return
+
+        for data in frames:
+            self.dispatcher.log_payload("Request: ", data)
+            connection.pending += 1
+            if self.pool is None:
+                reply = self.dispatcher.dispatch(data, callback = lambda reply, c = connection: self.complete(c, reply),
+                                                 received = now)
+                if not isinstance(reply, jsonrpc.AsyncResult):
+                    connection.pending -= 1
+                    self.push(connection, reply)
+            else:
+                try:
+                    self.pool.submit(self.dispatch_job, connection, data, now)
+                except RPCFault, err:
+                    connection.pending -= 1
+                    self.push(connection, self.dispatcher.error_reply(data, err))
+
+    def dispatch_job(self, connection, data, received):
+        """Dispatch a request in a thread of the pool."""
+        reply = self.dispatcher.dispatch(data, callback = lambda reply: self.complete(connection, reply),
+                                         received = received)
+        if not isinstance(reply, jsonrpc.AsyncResult):
+            self.complete(connection, reply)
+
+    def complete(self, connection, reply):
+        """Hand the reply of a request executed in another thread to the loop."""
+        self.completed.append((connection, reply))
+        self._wakeup()
+
+    def handle_completed(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+        while self.completed:
+            connection, reply = self.completed.popleft()
+            connection.pending -= 1
+            if not connection.closed:
+                self.push(connection, reply)
+
+    #----------------------
+    # sending
+
+    def push(self, connection, reply):
+        """Queue a reply (a string or a jsonrpc.StreamedReply) for sending.
+
+        None sends nothing. Replies pushed while a StreamedReply is sent
+        wait until it is complete.
+        """
+        if reply is None:
+            if connection.closing:
+                self.update(connection)
+            return
+        self.dispatcher.log_reply(reply)
+        if connection.stream is not None or connection.queue:
+            if connection.queue is None:
+                connection.queue = collections.deque()
+            connection.queue.append(reply)
+        elif isinstance(reply, jsonrpc.StreamedReply):
+            connection.stream = iter(connection.decoder.encode_stream(reply))
+        elif connection.outbuf:
+            connection.outbuf += connection.decoder.encode(reply)
+        else:
+            connection.outbuf = bytearray(connection.decoder.encode(reply))
+        self.handle_write(connection)
+
+    def fill(self, connection):
+        """Move chunks of the streamed reply and the queued replies to outbuf.
+
+        At most stream_buffer bytes are buffered, the next chunks are
+        produced when the socket is writable again.
+        """
+        if connection.outbuf is None:
+            connection.outbuf = bytearray()
+        while len(connection.outbuf) < self.stream_buffer:
+            if connection.stream is not None:
+                try:
+                    connection.outbuf += next(connection.stream)
+                    continue
+                except StopIteration:
+                    connection.stream = None
+            if not connection.queue:
+                break
+            reply = connection.queue.popleft()
+            if isinstance(reply, jsonrpc.StreamedReply):
+                connection.stream = iter(connection.decoder.encode_stream(reply))
+            else:
+                connection.outbuf += connection.decoder.encode(reply)
+
+    def handle_write(self, connection):
+        if connection.stream is not None or connection.queue:
+            self.fill(connection)
+        if connection.outbuf:
+            try:
+                sent = connection.sock.send(connection.outbuf)
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    sent = 0
+                elif err.args[0] in _DISCONNECTED:
+                    self.close(connection)
+                    return
+                else:
+                    raise
+            if sent:
+                del connection.outbuf[:sent]
+                self.touch(connection, time.time())
+            if not connection.outbuf:
+                connection.outbuf = None
+        self.update(connection)
+
+    def update(self, connection):
+        """Register for EVENT_WRITE while there is data to send, close when done."""
+        if connection.closed:
+            return
+        sending = bool(connection.outbuf or connection.stream is not None or connection.queue)
+        if not sending and connection.closing and not connection.pending:
+            self.close(connection)
+            return
+        if sending != connection.writing:
+            connection.writing = sending
+            self.poller.modify(connection.fd, EVENT_READ | EVENT_WRITE if sending else EVENT_READ)
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+"""
+Gateway routing JSON-RPC requests by method prefix to backend servers.
+
+The method names are namespaced by prefix ("test.Test"), so an API can be
+scaled horizontally by running it on several backend servers behind one
+gateway. Every request is forwarded to the backend of its route with the
+fewest outstanding requests, over pooled keep-alive connections. The
+reply of the backend is passed back without decoding it.
+
+A backend which fails max_failures times in a row (connection failures,
+transport errors and the gateway timeout; not the shorter timeout of a
+request, nor waiting for a free connection) is ejected for eject_time
+seconds; after that it gets requests again and is ejected at once if the
+next one fails. A request which could not be sent to a backend (connect failed)
+is sent to another backend of the route; a request which was sent is not
+repeated, it might have been executed.
+
+The Gateway is a jsonrpc.Dispatcher, so it is served by the server
+engines of test.py like the dispatcher of the APIs. It blocks the calling
+thread while waiting for the backend: use an engine with threads (not the
+single threaded event loop).
+"""
+
+import random
+import threading
+import time
+
+import jsonrpc
+import rpcclient
+from jsonrpc import RPCFault, RPCTransportError, RPCTimeoutError
+
+
+def parse_address(address):
+    """Parse "host:port" into (host, port), a path is a Unix domain socket."""
+    if "/" in address:
+        return address
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+class Backend:
+    """A backend server of a route.
+
+    :Variables:
+        - outstanding: requests sent and not yet answered
+        - failures:    consecutive failures
+    """
+    def __init__(self, address, pool_size = 64, connect_timeout = 1.0, max_idle = 25.0):
+        self.address = address
+        self.pool = rpcclient.ConnectionPool(address, pool_size, connect_timeout, max_idle)
+        self._lock = threading.Lock()
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def available(self, now):
+        """True if the backend is not ejected and has a free connection."""
+        return now >= self.ejected_until and self.outstanding < self.pool.size
+
+    def started(self):
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def finished(self):
+        with self._lock:
+            self.outstanding -= 1
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+
+    def failed(self, max_failures, eject_time):
+        """Count a failure, returns True if the backend is ejected now."""
+        with self._lock:
+            self.errors += 1
+            self.failures += 1
+            if self.failures < max_failures:
+                return False
+            self.ejected_until = time.time() + eject_time
+            self.ejections += 1
+            return True
+
+    def stats(self):
+        """Return a dict with the address, state and counters of the backend."""
+        with self._lock:
+            return {"address": "%s:%d" % self.address if isinstance(self.address, tuple) else self.address,
+                    "ejected": time.time() < self.ejected_until,
+                    "outstanding": self.outstanding, "requests": self.requests, "errors": self.errors,
+                    "ejections": self.ejections, "connections": self.pool.stats()}
+
+
+class Gateway(jsonrpc.Dispatcher):
+    """Dispatcher forwarding the requests to backend servers by prefix.
+
+    Functions registered at the gateway itself (e.g. system.gateway, the
+    statistics of the backends) are executed locally. The entries of a
+    batch are forwarded one by one (in parallel with a batch_pool), to the
+    backends of their routes.
+    """
+    def __init__(self, routes, timeout = 10.0, pool_size = 64, connect_timeout = 1.0,
+                 max_failures = 3, eject_time = 10.0, **kwargs):
+        """init
+
+        :Parameters:
+            - routes:          dict prefix -> list of backend addresses
+                               ((host, port) or a socket path). A method
+                               "prefix.name" is routed to the longest
+                               matching prefix, "" is the default route.
+            - timeout:         seconds to wait for a backend, the timeout of
+                               the request applies if it is shorter. The
+                               remaining time is sent to the backend.
+            - pool_size:       maximum connections (= outstanding requests)
+                               per backend
+            - connect_timeout: seconds to connect to a backend
+            - max_failures:    consecutive failures which eject a backend
+            - eject_time:      seconds a backend is ejected
+            - kwargs:          see jsonrpc.Dispatcher
+        """
+        jsonrpc.Dispatcher.__init__(self, **kwargs)
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.routes = {}
+        for prefix, addresses in routes.items():
+            self.routes[prefix] = [Backend(address, pool_size, connect_timeout) for address in addresses]
+        # longest prefix first
+        self._prefixes = sorted(self.routes, key = len, reverse = True)
+        self.register_function(self.report, name = "system.gateway")
+
+    def route(self, method):
+        """Return the backends of method, None if there is no route."""
+        for prefix in self._prefixes:
+            if not prefix or method.startswith(prefix + "."):
+                return self.routes[prefix]
+        return None
+
+    def choose(self, backends, exclude = ()):
+        """Return the available backend with the fewest outstanding requests, or None."""
+        now = time.time()
+        best = []
+        for backend in backends:
+            if backend in exclude or not backend.available(now):
+                continue
+            if not best or backend.outstanding < best[0].outstanding:
+                best = [backend]
+            elif backend.outstanding == best[0].outstanding:
+                best.append(backend)
+        if not best:
+            return None
+        return random.choice(best)
+
+    def report(self):
+        """Return the state of the backends, by route prefix."""
+        return dict((prefix, [backend.stats() for backend in backends])
+                    for prefix, backends in self.routes.items())
+
+    def _call(self, req, callback, received):
+        """Forward a request to a backend, see jsonrpc.Dispatcher._call."""
+        if isinstance(req, RPCFault) or req[0] in self.funcs:
+            return jsonrpc.Dispatcher._call(self, req, callback, received)
+        backends = self.route(req[0])
+        if backends is None:
+            return jsonrpc.Dispatcher._call(self, req, callback, received)   # method not found
+
+        method, params, id, timeout = req
+        # a timeout of the backend within a shorter timeout of the request
+        # says nothing about the backend
+        own_timeout = timeout is None or timeout >= self.timeout
+        if own_timeout:
+            timeout = self.timeout
+        deadline = received + timeout
+        try:
+            return self._forward(backends, method, params, id, deadline, own_timeout)
+        except RPCFault, err:
+            if self.stats is not None:
+                self.stats.error(err.error_code)
+            return self.data_serializer.dumps_error(err, id)
+
+    def _forward(self, backends, method, params, id, deadline, own_timeout = True):
+        """Send the request to a backend and return its (serialized) reply.
+
+        :Parameters:
+            - own_timeout: True if deadline is the timeout of the gateway,
+                           only then a timeout counts as backend failure
+        :Raises: RPCFault to reply to the client
+        """
+        tried = set()
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise jsonrpc.RPCRequestTimeout("Deadline exceeded before forwarding.")
+            backend = self.choose(backends, tried)
+            if backend is None:
+                raise jsonrpc.RPCServerBusy("No backend available for %s." % method)
+            request = self.data_serializer.dumps_request(method, params, id, round(remaining, 3))
+
+            try:
+                connection = backend.pool.acquire(deadline)
+            except RPCTimeoutError, err:
+                # before the deadline only the connect timeout expires;
+                # at the deadline there was no free connection (local
+                # congestion) or the request has no time left
+                if time.time() < deadline:
+                    self._failed(backend, err)
+                tried.add(backend)
+                continue
+            except RPCTransportError, err:
+                # not sent, the next backend may take it
+                self._failed(backend, err)
+                tried.add(backend)
+                continue
+
+            backend.started()
+            reused = connection.used > 0
+            try:
+                connection.send([request], deadline)
+                reply = connection.receive(deadline)
+            except RPCTimeoutError, err:
+                backend.pool.discard(connection)
+                if own_timeout:
+                    self._failed(backend, err)
+                raise jsonrpc.RPCRequestTimeout("No reply from the backend within the timeout.")
+            except RPCTransportError, err:
+                backend.pool.discard(connection)
+                if reused and not connection.received:
+                    continue    # idle connection closed by the backend, the request was not read
+                self._failed(backend, err)
+                raise jsonrpc.RPCInternalError("Backend failed.")
+            finally:
+                backend.finished()
+            backend.pool.release(connection)
+            backend.succeeded()
+            return reply
+
+    def _failed(self, backend, err):
+        if backend.failed(self.max_failures, self.eject_time):
+            self.logfile("Backend %s ejected for %s seconds: %s" % (backend.address, self.eject_time, err))
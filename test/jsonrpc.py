@@ -3,9 +3,11 @@
 """
 JSON-RPC (remote procedure call) server.
 
-Consists of two parts:
+Consists of three parts:
     - dispatcher
     - data structure / serializer
+    - framing (splitting a byte stream into messages), either raw JSON
+      or netstring ("<length>:<json>,") framed
 
 
 Currently JSON-RPC 1.0 is implemented
@@ -16,7 +18,7 @@ Currently JSON-RPC 1.0 is implemented
 
 :Note:      all exceptions derived from RPCFault are propagated to the client.
             other exceptions are logged and result in a sent-back "empty" INTERNAL_ERROR.
-:Uses:      simplejson, time, codecs
+:Uses:      ujson, simplejson or json (the fastest available), time, codecs
 :SeeAlso:   JSON-RPC 1.0 specification
 :Warning:
     .. Warning::
@@ -49,6 +51,23 @@ All rights reserved by Dean Connect and Leo Noordergraaf."""
 import SocketServer
 import codecs
 import time
+import re
+import os
+import sys
+import signal
+import bisect
+import random
+import types
+import collections
+import inspect
+import heapq
+import threading
+import traceback
+import multiprocessing
+import Queue
+import cProfile
+import pstats
+import gc
 
 #----------------------
 # error-codes + exceptions
@@ -65,6 +84,9 @@ PROCEDURE_EXCEPTION    = -32000
 AUTHENTIFICATION_ERROR = -32001
 PERMISSION_DENIED      = -32002
 INVALID_PARAM_VALUES   = -32003
+SERVER_BUSY            = -32004
+REQUEST_TIMEOUT        = -32005
+APPLICATION_ERROR      = -10100 #result {"error": ...} of a RPC-function
 
 #human-readable messages
 ERROR_MESSAGE = {
@@ -77,7 +99,10 @@ ERROR_MESSAGE = {
     PROCEDURE_EXCEPTION   : "Procedure exception.",
     AUTHENTIFICATION_ERROR: "Authentification error.",
     PERMISSION_DENIED     : "Permission denied.",
-    INVALID_PARAM_VALUES  : "Invalid parameter values."
+    INVALID_PARAM_VALUES  : "Invalid parameter values.",
+    SERVER_BUSY           : "Server busy.",
+    REQUEST_TIMEOUT       : "Request timeout.",
+    APPLICATION_ERROR     : "Application error."
 }
 
 #----------------------
@@ -164,17 +189,116 @@ class RPCInvalidParamValues(RPCFault):
     def __init__(self, error_data = None):
         RPCFault.__init__(self, INVALID_PARAM_VALUES, ERROR_MESSAGE[INVALID_PARAM_VALUES], error_data)
 
+class RPCServerBusy(RPCFault):
+    """SERVER_BUSY"""
+    def __init__(self, error_data = None):
+        RPCFault.__init__(self, SERVER_BUSY, ERROR_MESSAGE[SERVER_BUSY], error_data)
+
+class RPCRequestTimeout(RPCFault):
+    """REQUEST_TIMEOUT"""
+    def __init__(self, error_data = None):
+        RPCFault.__init__(self, REQUEST_TIMEOUT, ERROR_MESSAGE[REQUEST_TIMEOUT], error_data)
+
+#exception of a received error-code, other codes result in a plain RPCFault
+ERROR_CLASS = {
+    PARSE_ERROR           : RPCParseError,
+    INVALID_REQUEST       : RPCInvalidRPC,
+    METHOD_NOT_FOUND      : RPCMethodNotFound,
+    INVALID_METHOD_PARAMS : RPCInvalidMethodParams,
+    INTERNAL_ERROR        : RPCInternalError,
+
+    PROCEDURE_EXCEPTION   : RPCProcedureException,
+    AUTHENTIFICATION_ERROR: RPCAuthentificationError,
+    PERMISSION_DENIED     : RPCPermissionDenied,
+    INVALID_PARAM_VALUES  : RPCInvalidParamValues,
+    SERVER_BUSY           : RPCServerBusy,
+    REQUEST_TIMEOUT       : RPCRequestTimeout,
+}
+
 
 
 #=========================================
 # data structure / serializer
 
+#----------------------
+# json codecs
+
+class JsonCodec:
+    """A json-encoder/-decoder pair.
+
+    :Variables:
+        - name:  name of the json-module
+        - dumps: json-encoder-function, object -> str (bytes)
+        - loads: json-decoder-function, str -> object, raises ValueError
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return "<JsonCodec %s>" % self.name
+
+
+#: available codecs, by name
+CODECS = {}
+
+import json
+CODECS["json"] = JsonCodec("json",
+    lambda obj: json.dumps(obj, separators = (",", ":")), json.loads)
+
 try:
     import simplejson
-except ImportError, err:
-    print "FATAL: json-module 'simplejson' is missing (%s)" % (err)
-    sys.exit(1)
+    CODECS["simplejson"] = JsonCodec("simplejson",
+        lambda obj: simplejson.dumps(obj, separators = (",", ":")), simplejson.loads)
+except ImportError:
+    pass
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# output of ujson with ensure_ascii: non-ASCII bytes are copied from byte
+# strings which are no valid UTF-8
+_non_ascii = re.compile(r"[\x80-\xff]")
+
+def _ujson_dumps(obj):
+    """ujson.dumps, falling back to json where ujson is wrong."""
+    try:
+        data = ujson.dumps(obj, escape_forward_slashes = False)
+    except OverflowError:
+        return CODECS["json"].dumps(obj)   # integer beyond 64 bits
+    if _non_ascii.search(data) is not None:
+        return CODECS["json"].dumps(obj)   # raises UnicodeDecodeError
+    return data
+
+def _ujson_loads(string):
+    """ujson.loads, falling back to json where ujson fails."""
+    try:
+        return ujson.loads(string)
+    except ValueError:
+        return CODECS["json"].loads(string)    # e.g. "Value is too big!"
+
+if ujson is not None:
+    CODECS["ujson"] = JsonCodec("ujson", _ujson_dumps, _ujson_loads)
+
+#: codecs from fast to slow (for small messages), check with benchcodec.py.
+#: ujson only handles integers of up to 64 bits and copies byte strings
+#: which are no valid UTF-8 unchecked: these messages (and invalid json)
+#: are handled by json instead, at the cost of a second attempt.
+CODEC_PREFERENCE = ("ujson", "json", "simplejson")
+
+def get_codec(name = None):
+    """Return the codec name, or the fastest available codec if name is None.
+
+    :Raises: KeyError if the codec is not available
+    """
+    if name is not None:
+        return CODECS[name]
+    for name in CODEC_PREFERENCE:
+        if name in CODECS:
+            return CODECS[name]
 
 #----------------------
 # JSON-RPC 1.0
@@ -187,31 +311,36 @@ class JsonRpc10:
     Responses as empty/null.
 
     :SeeAlso:   JSON-RPC 1.0 specification
-    :TODO:      catch simplejson.dumps not-serializable-exceptions
+    :TODO:      catch dumps not-serializable-exceptions
     """
-    def __init__(self, dumps=simplejson.dumps, loads=simplejson.loads):
+    def __init__(self, dumps=None, loads=None, codec=None):
         """init: set serializer to use
 
         :Parameters:
-            - dumps: json-encoder-function
-            - loads: json-decoder-function
-        :Note: The dumps_* functions of this class already directly create
-               the invariant parts of the resulting json-object themselves,
-               without using the given json-encoder-function.
+            - dumps: json-encoder-function, default from codec
+            - loads: json-decoder-function, default from codec
+            - codec: JsonCodec, default the fastest available (get_codec())
+        :Note: The dumps_* functions of this class serialize the whole
+               json-object in a single call of the json-encoder-function.
         """
-        self.dumps = dumps
-        self.loads = loads
+        if codec is None:
+            codec = get_codec()
+        self.codec = codec
+        self.dumps = dumps or codec.dumps
+        self.loads = loads or codec.loads
 
 
-    def dumps_request(self, method, params=(), id = 0):
+    def dumps_request(self, method, params=(), id = 0, timeout = None):
         """serialize JSON-RPC-Request
 
         :Parameters:
-            - method: the method-name (str/unicode)
-            - params: the parameters (list/tuple)
-            - id:     if id=None, this results in a Notification
+            - method:  the method-name (str/unicode)
+            - params:  the parameters (list/tuple)
+            - id:      if id=None, this results in a Notification
+            - timeout: seconds the caller waits for the reply, the server
+                       drops the request when it can not start it in time
+                       (extension of JSON-RPC 1.0, omitted if None)
         :Returns:   | {"method": "...", "params": ..., "id": ...}
-                    | "method", "params" and "id" are always in this order.
         :Raises:    TypeError if method/params is of wrong type or
                     not JSON-serializable
         """
@@ -221,8 +350,9 @@ class JsonRpc10:
         if not isinstance(params, (tuple, list)):
             raise TypeError("params must be a tuple/list.")
 
-        return '{"method": %s, "params": %s, "id": %s}' % \
-            (self.dumps(method), self.dumps(params), self.dumps(id))
+        if timeout is not None:
+            return self.dumps({"method": method, "params": params, "id": id, "timeout": timeout})
+        return self.dumps({"method": method, "params": params, "id": id})
 
 
     def dumps_notification(self, method, params = ()):
@@ -230,7 +360,6 @@ class JsonRpc10:
 
         :Parameters: see dumps_request
         :Returns:   | {"method": "...", "params": ..., "id": null}
-                    | "method", "params" and "id" are always in this order.
         :Raises:    see dumps_request
         """
         if not isinstance(method, (str, unicode)):
@@ -238,30 +367,33 @@ class JsonRpc10:
         if not isinstance(params, (tuple, list)):
             raise TypeError("params must be a tuple/list.")
 
-        return '{"method": %s, "params": %s, "id": null}' % \
-                (self.dumps(method), self.dumps(params))
+        return self.dumps({"method": method, "params": params, "id": None})
 
 
     def dumps_response(self, result, id = None):
         """serialize a JSON-RPC-Response (without error)
 
+        A result which is a dict with an "error" key is sent as application
+        error (APPLICATION_ERROR) with result["error"] as message.
+
         :Returns:   | {"result": ..., "error": null, "id": ...}
-                    | "result", "error" and "id" are always in this order.
         :Raises:    TypeError if not JSON-serializable
         """
-        error = 1
-        try:
-            result['error']
-        except:
-          error = 0
+        if isinstance(result, dict) and "error" in result:
+            return self.dumps({"result": None,
+                               "error": {"code": APPLICATION_ERROR, "message": result["error"], "data": "Application error"},
+                               "id": id})
+        return self.dumps({"result": result, "error": None, "id": id})
 
-        if error:
-            result = '{"result": null, "error": {"code":-10100, "message": "%s", "data": "Application error"}, "id": %s}' % \
-                (result['error'], self.dumps(id))
-        else:
-            result = '{"result": %s, "error": null, "id": %s}' % \
-                (self.dumps(result), self.dumps(id))
-        return result
+
+    def dumps_raw_response(self, result, id = None):
+        """serialize a JSON-RPC-Response around an already serialized result
+
+        :Parameters:
+            - result: the json-encoded result (str), e.g. from a cache
+        :Returns:   | {"result": ..., "error": null, "id": ...}
+        """
+        return '{"result":%s,"error":null,"id":%s}' % (result, self.dumps(id))
 
 
     def dumps_error(self, error, id = None):
@@ -273,19 +405,65 @@ class JsonRpc10:
         :Parameters:
             - error: a RPCFault instance
         :Returns:   | {"result": null, "error": {"code": error_code, "message": error_message, "data": error_data}, "id": ...}
-                    | "result", "error" and "id" are always in this order, data is omitted if None.
+                    | data is omitted if None.
         :Raises:    ValueError if error is not a RPCFault instance,
                     TypeError if not JSON-serializable
         """
         if not isinstance(error, RPCFault):
             raise ValueError("""error must be a RPCFault-instance.""")
 
+        return self.dumps({"result": None, "error": self._fault(error), "id": id})
+
+    def _fault(self, error):
+        """Return the JSON-RPC 2.0 error-object of a RPCFault as dict."""
         if error.error_data is None:
-            return '{"result": null, "error": {"code":%s, "message": %s}, "id": %s}' % \
-                (self.dumps(error.error_code), self.dumps(error.error_message), self.dumps(id))
-        else:
-            return '{"result": null, "error": {"code":%s, "message": %s, "data": %s}, "id": %s}' % \
-                (self.dumps(error.error_code), self.dumps(error.error_message), self.dumps(error.error_data), self.dumps(id))
+            return {"code": error.error_code, "message": error.error_message}
+        return {"code": error.error_code, "message": error.error_message, "data": error.error_data}
+
+
+    def dumps_stream(self, iterable, id = None, chunk_size = 65536, on_error = None):
+        """serialize a JSON-RPC-Response with an iterable result, in chunks
+
+        The result is encoded element by element as JSON array, so memory
+        use is bounded by chunk_size instead of the size of the result. If
+        the iteration fails, the array is closed and the error is set: the
+        client gets the partial result together with the error.
+
+        :Parameters:
+            - iterable:   the result
+            - chunk_size: minimal size (bytes) of the chunks
+            - on_error:   called with sys.exc_info() if the iteration fails
+        :Returns:   generator of strings, joined they form
+                    | {"result": [...], "error": null, "id": ...}
+        """
+        dumps = self.dumps
+        separator = '{"result":['     # prefix of the next chunk
+        parts = []
+        size = 0
+        error = None
+        try:
+            for item in iterable:
+                part = dumps(item)
+                parts.append(part)
+                size += len(part) + 1
+                if size >= chunk_size:
+                    yield separator + ",".join(parts)
+                    separator = ","
+                    parts = []
+                    size = 0
+        except Exception, err:
+            if on_error is not None:
+                on_error(sys.exc_info())
+            if not isinstance(err, RPCFault):
+                err = RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], "Result stream aborted.")
+            error = self._fault(err)
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        if separator == "," and not parts:
+            separator = ""
+        yield '%s%s],"error":%s,"id":%s}' % (separator, ",".join(parts), dumps(error), dumps(id))
 
 
     def loads_request(self, string):
@@ -301,6 +479,41 @@ class JsonRpc10:
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
 
+        return self._check_request(data)[:3]
+
+
+    def loads_batch(self, string):
+        """de-serialize a JSON-RPC Request or a batch (array) of Requests
+
+        :Returns:   | (requests, batch)
+                    | requests: list of [method_name, params, id, timeout],
+                      timeout is None if the request has none;
+                      invalid entries of a batch are RPCFault-instances
+                    | batch: True if string contains an array
+        :Raises:    RPCParseError, RPCInvalidRPC (also for an empty batch)
+        """
+        try:
+            data = self.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+
+        if not isinstance(data, list):
+            return [self._check_request(data)], False
+
+        if not data:
+            raise RPCInvalidRPC("Invalid Request, empty batch.")
+
+        requests = []
+        for entry in data:
+            try:
+                requests.append(self._check_request(entry))
+            except RPCFault, err:
+                requests.append(err)
+        return requests, True
+
+
+    def _check_request(self, data):
+        """validate a de-serialized Request, see loads_request"""
         if not isinstance(data, dict):
             raise RPCInvalidRPC("No valid RPC-package.")
 
@@ -320,7 +533,13 @@ class JsonRpc10:
         if not isinstance(data["params"], (list, tuple)):
             raise RPCInvalidRPC("""Invalid Request, "params" must be an array.""")
 
-        if len(data) != 3:
+        # optional: seconds the client waits for the reply
+        timeout = data.get("timeout")
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, long, float))
+                                    or timeout < 0):
+            raise RPCInvalidRPC("""Invalid Request, "timeout" must be a number >= 0.""")
+
+        if len(data) != (4 if "timeout" in data else 3):
             raise RPCInvalidRPC("""Invalid Request, additional fields found.""")
 
         # notification / request
@@ -328,7 +547,20 @@ class JsonRpc10:
         #if data["id"] is None:
         #    return data["method"], data["params"]               #notification
         #else:
-        return data["method"], data["params"], data["id"]   #request
+        return data["method"], data["params"], data["id"], timeout   #request
+
+
+    def dumps_batch(self, replies):
+        """serialize the replies to a batch of Requests
+
+        :Parameters:
+            - replies: list of serialized Responses/errors
+        :Returns:   | [reply, reply, ...]
+                    | None if there is nothing to send back (only Notifications)
+        """
+        if not replies:
+            return None
+        return "[%s]" % ",".join(replies)
 
 
     def loads_response(self, string):
@@ -345,6 +577,34 @@ class JsonRpc10:
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
 
+        result, id = self._check_response(data)
+        if isinstance(result, RPCFault):
+            raise result
+        return result, id
+
+
+    def loads_batch_response(self, string):
+        """de-serialize a JSON-RPC Response/error or the reply to a batch
+
+        :Returns: | (responses, batch)
+                  | responses: list of [result, id], result is a
+                    RPCFault-instance for error-packages (see loads_response)
+                  | batch: True if string contains an array, a batch
+                    rejected as a whole is answered with a single error
+        :Raises:  RPCParseError, RPCInvalidRPC
+        """
+        try:
+            data = self.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+
+        if not isinstance(data, list):
+            return [self._check_response(data)], False
+        return [self._check_response(entry) for entry in data], True
+
+
+    def _check_response(self, data):
+        """validate a de-serialized Response, see loads_batch_response"""
         if not isinstance(data, dict):
             raise RPCInvalidRPC("No valid RPC-package.")
 
@@ -382,40 +642,2099 @@ class JsonRpc10:
                 else:
                     error_data = data["error"]["data"]
 
-                if data["error"]["code"] == PARSE_ERROR:
-                    raise RPCParseError(error_data)
+                error_class = None
+                if isinstance(data["error"]["code"], (int, long)):
+                    error_class = ERROR_CLASS.get(data["error"]["code"])
+                if error_class is not None:
+                    return error_class(error_data), data["id"]
+                return RPCFault(data["error"]["code"], data["error"]["message"], error_data), data["id"]
+
+            #other error-format
+            else:
+                return RPCFault(-1, "Error", data["error"]), data["id"]
+
+        #result
+        else:
+            return data["result"], data["id"]
 
-                elif data["error"]["code"] == INVALID_REQUEST:
-                    raise RPCInvalidRPC(error_data)
 
-                elif data["error"]["code"] == METHOD_NOT_FOUND:
-                    raise RPCMethodNotFound(error_data)
+#=========================================
+# framing
 
-                elif data["error"]["code"] == INVALID_METHOD_PARAMS:
-                    raise RPCInvalidMethodParams(error_data)
+class JsonFrameDecoder:
+    """Incremental splitter of a byte stream into JSON documents (frames).
 
-                elif data["error"]["code"] == INTERNAL_ERROR:
-                    raise RPCInternalError(error_data)
+    A frame is a top-level JSON object or array and ends where its
+    brackets balance. Brackets inside strings (including escaped quotes)
+    are ignored, whitespace between frames is skipped.
 
-                elif data["error"]["code"] == PROCEDURE_EXCEPTION:
-                    raise RPCProcedureException(error_data)
+    The received data is kept in one growing bytearray and the scan state
+    is kept between calls of feed(), so every byte is scanned only once,
+    independent of how the stream is chunked.
 
-                elif data["error"]["code"] == AUTHENTIFICATION_ERROR:
-                    raise RPCAuthentificationError(error_data)
+    :Variables:
+        - max_frame_size: maximum size in bytes of a (partial) frame,
+                          None for unlimited
+    """
+    _special        = re.compile(r'[][{}"]')    # outside of strings
+    _string_special = re.compile(r'["\\]')     # inside of strings
+    _whitespace     = frozenset((0x20, 0x09, 0x0a, 0x0d))
 
-                elif data["error"]["code"] == PERMISSION_DENIED:
-                    raise RPCPermissionDenied(error_data)
+    def __init__(self, max_frame_size = None):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self._start = None          # start of the current frame in buffer
+        self._pos = 0               # scan position in buffer
+        self._depth = 0
+        self._in_string = False
 
-                elif data["error"]["code"] == INVALID_PARAM_VALUES:
-                    raise RPCInvalidParamValues(error_data)
+    def feed(self, data):
+        """Append received data and return the completed frames.
 
+        :Parameters:
+            - data: received bytes (str, bytearray or memoryview)
+        :Returns:   list of complete frames (str), possibly empty
+        :Raises:    RPCParseError if the stream does not contain JSON
+                    objects/arrays or a frame exceeds max_frame_size.
+                    The decoder must not be used after this.
+        """
+        buf = self.buffer
+        buf[len(buf):] = data
+        end = len(buf)
+        pos = self._pos
+        start = self._start
+        depth = self._depth
+        in_string = self._in_string
+        frames = []
+
+        while pos < end:
+            if start is None:
+                c = buf[pos]
+                if c in (0x7b, 0x5b):               # { [
+                    start = pos
+                    depth = 1
+                    pos += 1
+                elif c in self._whitespace:
+                    pos += 1
                 else:
-                    raise RPCFault(data["error"]["code"], data["error"]["message"], error_data)
+                    raise RPCParseError("No valid JSON frame.")
+
+            elif in_string:
+                m = self._string_special.search(buf, pos, end)
+                if m is None:
+                    pos = end
+                elif buf[m.start()] == 0x5c:        # backslash, skip escaped char
+                    pos = m.start() + 2
+                else:
+                    in_string = False
+                    pos = m.start() + 1
 
-            #other error-format
             else:
-                raise RPCFault(-1, "Error", data["error"])
+                m = self._special.search(buf, pos, end)
+                if m is None:
+                    pos = end
+                    break
+                pos = m.start() + 1
+                c = buf[m.start()]
+                if c == 0x22:                       # "
+                    in_string = True
+                elif c in (0x7b, 0x5b):
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        frames.append(str(buf[start:pos]))
+                        start = None
+
+        # discard consumed data, the scan position may point beyond the
+        # end of the buffer after a trailing backslash
+        consumed = min(pos, end) if start is None else start
+        if consumed:
+            del buf[:consumed]
+            pos -= consumed
+            if start is not None:
+                start = 0
+
+        if (start is not None and self.max_frame_size is not None and
+                len(buf) > self.max_frame_size):
+            raise RPCParseError("Frame exceeds %d bytes." % self.max_frame_size)
+
+        self._pos = pos
+        self._start = start
+        self._depth = depth
+        self._in_string = in_string
+        return frames
+
+    def encode(self, message):
+        """Frame an outgoing message (raw JSON is sent as is)."""
+        return message
+
+    def encode_stream(self, reply):
+        """Frame an outgoing StreamedReply, returns an iterable of chunks."""
+        return reply
+
+
+class NetstringFrameDecoder:
+    """Incremental decoder of netstring framed messages.
+
+    Every message is prefixed by its length: "<length>:<json>,", so the
+    receiver knows how many bytes to expect and does not have to scan the
+    message itself.
 
-        #result
+    :Variables:
+        - max_frame_size: maximum length of a message, None for unlimited
+    """
+    _max_header = 10                # digits of the length
+
+    def __init__(self, max_frame_size = None):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self._length = None         # length of the current message
+
+    def feed(self, data):
+        """Append received data and return the completed frames.
+
+        :Parameters: see JsonFrameDecoder.feed
+        :Returns:    list of complete messages (str) without the framing
+        :Raises:     RPCParseError on an invalid netstring or if a message
+                     exceeds max_frame_size.
+        """
+        buf = self.buffer
+        buf[len(buf):] = data
+        pos = 0
+        frames = []
+
+        while True:
+            if self._length is None:
+                colon = buf.find(":", pos, pos + self._max_header + 1)
+                if colon < 0:
+                    if len(buf) - pos > self._max_header:
+                        raise RPCParseError("Invalid netstring length.")
+                    break
+                header = str(buf[pos:colon])
+                if not header.isdigit():
+                    raise RPCParseError("Invalid netstring length.")
+                self._length = int(header)
+                if self.max_frame_size is not None and self._length > self.max_frame_size:
+                    raise RPCParseError("Frame exceeds %d bytes." % self.max_frame_size)
+                pos = colon + 1
+
+            end = pos + self._length
+            if len(buf) <= end:
+                break
+            if buf[end] != 0x2c:            # ,
+                raise RPCParseError("Netstring not terminated by ','.")
+            frames.append(str(buf[pos:end]))
+            self._length = None
+            pos = end + 1
+
+        if pos:
+            del buf[:pos]
+        return frames
+
+    def encode(self, message):
+        """Frame an outgoing message as netstring."""
+        return "%d:%s," % (len(message), message)
+
+    def encode_stream(self, reply):
+        """Frame an outgoing StreamedReply.
+
+        The length precedes the message, so the reply is joined first.
+        """
+        return [self.encode(reply.join())]
+
+
+class AutoFrameDecoder:
+    """Frame decoder negotiating the framing from the first received byte.
+
+    A client which starts with a digit uses netstring framing, all other
+    clients use raw JSON framing. Replies are framed the same way.
+    """
+    def __init__(self, max_frame_size = None):
+        self.max_frame_size = max_frame_size
+        self.decoder = None
+
+    def feed(self, data):
+        """see JsonFrameDecoder.feed"""
+        if self.decoder is None:
+            data = memoryview(data).tobytes().lstrip()
+            if not data:
+                return []
+            if data[0].isdigit():
+                self.decoder = NetstringFrameDecoder(self.max_frame_size)
+            else:
+                self.decoder = JsonFrameDecoder(self.max_frame_size)
+        return self.decoder.feed(data)
+
+    def encode(self, message):
+        """see JsonFrameDecoder.encode"""
+        if isinstance(self.decoder, NetstringFrameDecoder):
+            return self.decoder.encode(message)
+        return message
+
+    def encode_stream(self, reply):
+        """see JsonFrameDecoder.encode_stream"""
+        if isinstance(self.decoder, NetstringFrameDecoder):
+            return self.decoder.encode_stream(reply)
+        return reply
+
+
+#: available framings, by name
+FRAMINGS = {
+    "auto"      : AutoFrameDecoder,
+    "json"      : JsonFrameDecoder,
+    "netstring" : NetstringFrameDecoder,
+}
+
+
+#=========================================
+# statistics
+
+class Histogram:
+    """Latency histogram with fixed buckets.
+
+    Not thread-safe, the owner (MethodStats/Stats) holds its lock.
+
+    :Variables:
+        - BUCKETS: upper bounds (seconds) of the buckets, an observation
+                   above the last bound is counted in an extra bucket
+    """
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+               0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Add an observation."""
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Estimate the q-th percentile (0 < q <= 100) by the bucket bound.
+
+        :Returns: seconds, None if there are no observations
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and i < len(self.BUCKETS):
+                return min(self.BUCKETS[i], self.max)
+        return self.max
+
+    def snapshot(self):
+        """Return a dict with count and the latencies in milliseconds."""
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+        return {"count": self.count,
+                "avg_ms": ms(self.sum / self.count) if self.count else None,
+                "max_ms": ms(self.max),
+                "p50_ms": ms(self.percentile(50)),
+                "p90_ms": ms(self.percentile(90)),
+                "p99_ms": ms(self.percentile(99))}
+
+    def prometheus(self, lines, name, labels = ""):
+        """Append the histogram in Prometheus text format to lines."""
+        sep = "," if labels else ""
+        cumulative = 0
+        for bound, n in zip(self.BUCKETS + ("+Inf",), self.counts):
+            cumulative += n
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, cumulative))
+        labels = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %r" % (name, labels, self.sum))
+        lines.append("%s_count%s %d" % (name, labels, self.count))
+
+
+class MethodStats:
+    """Counters and latency histograms of a RPC-method.
+
+    :Variables:
+        - calls:     number of requests (including cache hits and
+                     coalesced requests)
+        - errors:    error-code -> number of error replies
+        - bytes_out: size of the replies
+        - execute:   Histogram of the execution of the function
+        - serialize: Histogram of the serialization of the reply
+        - cache:     the ResultCache of the method or None
+    """
+    def __init__(self, cache = None):
+        self._lock = threading.Lock()
+        self.cache = cache
+        self.calls = 0
+        self.errors = {}
+        self.bytes_out = 0
+        self.execute = Histogram()
+        self.serialize = Histogram()
+
+    def called(self):
+        with self._lock:
+            self.calls += 1
+
+    def executed(self, seconds):
+        with self._lock:
+            self.execute.observe(seconds)
+
+    def replied(self, code, reply, seconds = None):
+        """Count a reply.
+
+        :Parameters:
+            - code:    error-code, None for a result
+            - reply:   the serialized reply (None for notifications)
+            - seconds: time taken to serialize the reply
+        """
+        with self._lock:
+            if code is not None:
+                self.errors[code] = self.errors.get(code, 0) + 1
+            if isinstance(reply, StreamedReply):
+                reply.add_done_callback(self._streamed)
+            elif reply is not None:
+                self.bytes_out += len(reply)
+            if seconds is not None:
+                self.serialize.observe(seconds)
+
+    def _streamed(self, reply):
+        with self._lock:
+            self.bytes_out += reply.size
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {"calls": self.calls,
+                        "errors": _error_list(self.errors),
+                        "bytes_out": self.bytes_out,
+                        "execute": self.execute.snapshot(),
+                        "serialize": self.serialize.snapshot()}
+        if self.cache is not None:
+            snapshot["cache"] = self.cache.stats()
+        return snapshot
+
+
+def _error_list(errors):
+    """Turn a dict error-code -> count into a json-serializable list."""
+    return [{"code": code, "message": ERROR_MESSAGE.get(code, ""), "count": count}
+            for code, count in sorted(errors.items())]
+
+
+class Stats:
+    """Statistics of a Dispatcher.
+
+    Counts the received messages, bytes in/out, the time to parse a
+    message and the errors which can not be attributed to a method (parse
+    errors, unknown methods, rejected requests); and keeps a MethodStats
+    per registered method. A Dispatcher with Stats serves them as the
+    reserved RPC-method "system.stats".
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = {}            # error-code -> count
+        self.parse = Histogram()
+        self.methods = {}           # name -> MethodStats
+
+    def method(self, name, cache = None):
+        """Return the (new) MethodStats of method name."""
+        with self._lock:
+            stats = self.methods.get(name)
+            if stats is None:
+                stats = self.methods[name] = MethodStats(cache)
+            return stats
+
+    def received(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes_in += size
+
+    def parsed(self, seconds):
+        with self._lock:
+            self.parse.observe(seconds)
+
+    def error(self, code):
+        with self._lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def sent(self, reply):
+        """Count a sent reply (None is not sent), returns reply."""
+        if isinstance(reply, StreamedReply):
+            reply.add_done_callback(self._streamed)
+        elif reply is not None:
+            with self._lock:
+                self.bytes_out += len(reply)
+        return reply
+
+    def _streamed(self, reply):
+        with self._lock:
+            self.bytes_out += reply.size
+
+    def sending(self, callback):
+        """Wrap a reply callback to count the replies it sends."""
+        return lambda reply: callback(self.sent(reply))
+
+    def snapshot(self):
+        """Return all statistics as json-serializable dict."""
+        methods = dict((name, stats.snapshot()) for name, stats in self.methods.items())
+        with self._lock:
+            snapshot = {"uptime": round(time.time() - self.started, 3),
+                        "messages": self.messages,
+                        "bytes_in": self.bytes_in,
+                        "bytes_out": self.bytes_out,
+                        "parse": self.parse.snapshot()}
+        snapshot["errors"] = _error_list(self.error_totals())
+        snapshot["methods"] = methods
+        return snapshot
+
+    def error_totals(self):
+        """Return error-code -> number of all error replies, those of the
+        methods included."""
+        with self._lock:
+            errors = dict(self.errors)
+        for stats in self.methods.values():
+            with stats._lock:
+                for code, count in stats.errors.items():
+                    errors[code] = errors.get(code, 0) + count
+        return errors
+
+    def prometheus(self):
+        """Return all statistics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines.append("# TYPE jsonrpc_messages_total counter")
+            lines.append("jsonrpc_messages_total %d" % self.messages)
+            lines.append("# TYPE jsonrpc_bytes_in_total counter")
+            lines.append("jsonrpc_bytes_in_total %d" % self.bytes_in)
+            lines.append("# TYPE jsonrpc_bytes_out_total counter")
+            lines.append("jsonrpc_bytes_out_total %d" % self.bytes_out)
+            lines.append("# TYPE jsonrpc_parse_seconds histogram")
+            self.parse.prometheus(lines, "jsonrpc_parse_seconds")
+
+        # all errors like system.stats, jsonrpc_method_errors_total splits
+        # those of the methods by method
+        lines.append("# TYPE jsonrpc_errors_total counter")
+        for code, count in sorted(self.error_totals().items()):
+            lines.append('jsonrpc_errors_total{code="%d"} %d' % (code, count))
+
+        methods = sorted(self.methods.items())
+        for metric, kind in (("calls_total", "counter"), ("method_errors_total", "counter"),
+                             ("method_bytes_out_total", "counter"), ("execute_seconds", "histogram"),
+                             ("serialize_seconds", "histogram")):
+            lines.append("# TYPE jsonrpc_%s %s" % (metric, kind))
+            for name, stats in methods:
+                label = 'method="%s"' % name.replace("\\", "\\\\").replace('"', '\\"')
+                with stats._lock:
+                    if metric == "calls_total":
+                        lines.append("jsonrpc_calls_total{%s} %d" % (label, stats.calls))
+                    elif metric == "method_errors_total":
+                        for code, count in sorted(stats.errors.items()):
+                            lines.append('jsonrpc_method_errors_total{%s,code="%d"} %d' % (label, code, count))
+                    elif metric == "method_bytes_out_total":
+                        lines.append("jsonrpc_method_bytes_out_total{%s} %d" % (label, stats.bytes_out))
+                    elif metric == "execute_seconds":
+                        stats.execute.prometheus(lines, "jsonrpc_execute_seconds", label)
+                    else:
+                        stats.serialize.prometheus(lines, "jsonrpc_serialize_seconds", label)
+        return "\n".join(lines) + "\n"
+
+    def report(self, format = "json"):
+        """RPC-method system.stats.
+
+        :Parameters:
+            - format: "json" (a dict) or "prometheus" (a string in the
+                      Prometheus text exposition format)
+        """
+        if format == "prometheus":
+            return self.prometheus()
+        if format != "json":
+            raise RPCInvalidParamValues("Unknown format %s." % format)
+        return self.snapshot()
+
+
+#=========================================
+# logging
+
+class AsyncLogger:
+    """Logger writing from a background thread.
+
+    Messages are queued and written by a daemon thread, so logging never
+    blocks the request handling: when the queue is full, messages are
+    dropped and counted. Request/reply payloads are sampled and truncated.
+    Tracebacks are formatted in the background thread, and a traceback
+    which repeats (same exception type and location) is written at most
+    once per traceback_interval, with the number of suppressed repetitions.
+
+    :Variables:
+        - sample_rate:        fraction (0..1) of the payloads which are logged
+        - max_payload:        payloads are truncated to max_payload
+                              characters, None for unlimited
+        - traceback_interval: minimal seconds between identical tracebacks
+    """
+    def __init__(self, output = None, sample_rate = 1.0, max_payload = 1024,
+                 traceback_interval = 60, queue_size = 10000):
+        """init
+
+        :Parameters:
+            - output:     file to write to, default sys.stdout
+            - queue_size: maximum number of messages waiting to be written
+        """
+        self.output = output
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        self.traceback_interval = traceback_interval
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._tracebacks = {}       # (type, file, line) -> [last written, suppressed]
+        self._start()
+
+    def _start(self):
+        # also called in a forked child, the thread does not survive fork()
+        self._pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target = self._run, name = "AsyncLogger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, message):
+        """Log a message."""
+        self._put(("message", message))
+
+    def log_payload(self, prefix, data):
+        """Log (a sample of) request or reply data, truncated to max_payload."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        size = len(data)
+        if self.max_payload is not None and size > self.max_payload:
+            data = data[:self.max_payload]
+        self._put(("payload", prefix, data, size))
+
+    def log_exception(self, exc_info):
+        """Log an unexpected exception (from sys.exc_info()) with traceback."""
+        tb = exc_info[2]
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        if tb is None:
+            key = (exc_info[0], None, None)
         else:
-            return data["result"], data["id"]
+            key = (exc_info[0], tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+        now = time.time()
+        with self._lock:
+            seen = self._tracebacks.get(key)
+            if seen is not None and now - seen[0] < self.traceback_interval:
+                seen[1] += 1
+                return
+            suppressed = seen[1] if seen is not None else 0
+            self._tracebacks[key] = [now, 0]
+        self._put(("exception", exc_info, suppressed))
+
+    def _put(self, entry):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(entry)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _format(self, entry):
+        if entry[0] == "message":
+            return str(entry[1])
+        if entry[0] == "payload":
+            kind, prefix, data, size = entry
+            if len(data) < size:
+                return "%s%s... (%d bytes)" % (prefix, data, size)
+            return prefix + data
+        kind, (exc_type, exc_value, exc_traceback), suppressed = entry
+        message = "%d (%s): %s\n%s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(exc_value),
+                                       repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+        if suppressed:
+            message += "\n(%d identical tracebacks suppressed)" % suppressed
+        return message
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            entry = queue.get()
+            if entry is None:
+                break
+            output = self.output or sys.stdout
+            try:
+                output.write(self._format(entry) + "\n")
+                if queue.empty():
+                    with self._lock:
+                        dropped, self.dropped = self.dropped, 0
+                    if dropped:
+                        output.write("(%d log messages dropped)\n" % dropped)
+                    output.flush()
+            except Exception:
+                pass        # never let logging kill the thread
+
+    def close(self, timeout = 1.0):
+        """Write the queued messages and stop the thread."""
+        try:
+            self.queue.put(None, timeout = timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+_default_logger = []
+
+def default_logger():
+    """Return the AsyncLogger shared by the users which were given none."""
+    if not _default_logger:
+        with _default_lock:
+            if not _default_logger:
+                _default_logger.append(AsyncLogger())
+    return _default_logger[0]
+
+_default_lock = threading.Lock()
+
+
+#=========================================
+# profiling
+
+def heap_counts():
+    """Return a dict type name -> number of live objects.
+
+    Only objects tracked by the garbage collector (containers, instances)
+    are counted, not e.g. strings and numbers.
+    """
+    counts = collections.defaultdict(int)
+    for obj in gc.get_objects():
+        counts[getattr(obj, "__class__", type(obj)).__name__] += 1
+    return counts
+
+
+class Profiler:
+    """On-demand profiling of the dispatching of selected methods.
+
+    Passed to the Dispatcher, which serves it as the RPC-methods
+    system.profile.start, system.profile.stop and system.profile.status.
+    While profiling is stopped, the dispatching is not touched at all:
+    start() replaces dispatch of the dispatcher by a sampling wrapper,
+    stop() removes it again.
+
+    A sampled request is dispatched under cProfile (one at a time, other
+    requests are not sampled meanwhile), the profiles are accumulated per
+    method. stop() writes them as pstats files, with a summary of the
+    time spent in the (de)serialization by the data_serializer, in the
+    RPC-function (user code) and in the rest of the dispatching. Work done
+    in other threads (e.g. completing an AsyncResult) or while sending (a
+    streamed result) is not profiled.
+    The heap (see heap_counts) is compared between start and stop.
+
+    :Variables:
+        - directory: where the files are written
+    """
+    # serializer methods counted as (de)serialization
+    serializer_methods = ("loads_batch", "dumps_response", "dumps_raw_response", "dumps_error",
+                          "dumps_batch", "dumps_stream")
+    # number of types with the largest growth in the heap file
+    heap_types = 50
+    _method = re.compile(r'"method"\s*:\s*"((?:[^"\\]|\\.)*)"')
+    _filename = re.compile(r"[^A-Za-z0-9_.-]|^\.")
+
+    def __init__(self, directory = None):
+        if directory is None:
+            directory = os.path.join("/tmp", "jsonrpc-profile")
+        self.directory = directory
+        self.dispatcher = None
+        self.active = False
+        self.methods = None
+        self.sample_rate = 0.0
+        self.started = None
+        self.profiles = {}          # method -> cProfile.Profile
+        self.samples = {}           # method -> number of profiled requests
+        self._heap = None
+        self._lock = threading.Lock()   # held while a request is profiled
+
+    def attach(self, dispatcher):
+        """Register the RPC-methods at dispatcher (called by the Dispatcher)."""
+        self.dispatcher = dispatcher
+        dispatcher.register_function(self.start, name = "system.profile.start")
+        dispatcher.register_function(self.stop, name = "system.profile.stop")
+        dispatcher.register_function(self.status, name = "system.profile.status")
+
+    def start(self, methods = None, sample_rate = 0.01):
+        """Start profiling (again, the previous profiles are discarded).
+
+        :Parameters:
+            - methods:     list of the names of the methods to profile,
+                           None for all
+            - sample_rate: fraction (0..1] of their requests to profile
+        :Returns: see status
+        :Raises:  RPCInvalidParamValues
+        """
+        if methods is not None and not isinstance(methods, list):
+            raise RPCInvalidParamValues("methods must be a list of names or null.")
+        if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, long, float)) or \
+                not 0 < sample_rate <= 1:
+            raise RPCInvalidParamValues("sample_rate must be a number in (0, 1].")
+        with self._lock:
+            self.methods = None if methods is None else frozenset(methods)
+            self.sample_rate = sample_rate
+            self.profiles = {}
+            self.samples = {}
+            self.started = time.time()
+            self._heap = heap_counts()
+            self.active = True
+        self.dispatcher.dispatch = self._dispatch
+        return self.status()
+
+    def stop(self):
+        """Stop profiling and write the profiles and the heap comparison.
+
+        :Returns: dict with the written files and the time of the sampled
+                  requests per method in ms: total, serialization, user
+                  code and other (dispatching), or None if not profiling
+        """
+        if not self.active:
+            return None
+        self.active = False
+        self.dispatcher.__dict__.pop("dispatch", None)
+        with self._lock:            # wait for the request being profiled
+            return self.dump()
+
+    def toggle(self, sample_rate = 0.01):
+        """Start profiling all methods, or stop it (e.g. on a signal)."""
+        if self.active:
+            self.dispatcher.logfile("Profile written: %s" % self.stop())
+        else:
+            self.start(None, sample_rate)
+            self.dispatcher.logfile("Profiling %s of the requests" % sample_rate)
+
+    def status(self):
+        """Return a dict with active, methods, sample_rate, samples and directory."""
+        return {"active": self.active,
+                "methods": None if self.methods is None else sorted(self.methods),
+                "sample_rate": self.sample_rate, "samples": dict(self.samples),
+                "directory": self.directory}
+
+    def _dispatch(self, rpcstr, callback = None, received = None):
+        """dispatch of the dispatcher while profiling."""
+        dispatch = self.dispatcher.__class__.dispatch
+        if random.random() >= self.sample_rate:
+            return dispatch(self.dispatcher, rpcstr, callback, received)
+        match = self._method.search(rpcstr)
+        method = match.group(1) if match else None
+        # only registered methods (the names become file names), never
+        # system.profile.* (stop waits for the request being profiled)
+        if method is None or method not in self.dispatcher.funcs or method.startswith("system.profile.") or \
+                (self.methods is not None and method not in self.methods) or not self._lock.acquire(False):
+            return dispatch(self.dispatcher, rpcstr, callback, received)
+        try:
+            if not self.active:
+                return dispatch(self.dispatcher, rpcstr, callback, received)
+            profile = self.profiles.get(method)
+            if profile is None:
+                profile = self.profiles[method] = cProfile.Profile()
+            self.samples[method] = self.samples.get(method, 0) + 1
+            profile.enable()
+            try:
+                return dispatch(self.dispatcher, rpcstr, callback, received)
+            finally:
+                profile.disable()
+        finally:
+            self._lock.release()
+
+    def dump(self):
+        """Write the profiles and the heap comparison, see stop."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = "%d-%s" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)))
+        summary = {"methods": {}}
+        for method, profile in self.profiles.items():
+            filename = os.path.join(self.directory, "%s-%s.pstats" % (self._filename.sub("_", method), stamp))
+            profile.dump_stats(filename)
+            breakdown = self._breakdown(pstats.Stats(profile), self.dispatcher.funcs.get(method))
+            breakdown.update({"samples": self.samples[method], "file": filename})
+            summary["methods"][method] = breakdown
+
+        if self._heap is not None:
+            filename = os.path.join(self.directory, "heap-%s.txt" % stamp)
+            before, after = self._heap, heap_counts()
+            growth = sorted(after, key = lambda name: after[name] - before.get(name, 0), reverse = True)
+            with open(filename, "w") as f:
+                f.write("%-40s %10s %10s\n" % ("type", "objects", "growth"))
+                for name in growth[:self.heap_types]:
+                    f.write("%-40s %10d %+10d\n" % (name, after[name], after[name] - before.get(name, 0)))
+            summary["heap"] = filename
+        return summary
+
+    def _breakdown(self, stats, function):
+        """Split the time of the sampled requests, in ms (see stop)."""
+        def key(code):
+            return (code.co_filename, code.co_firstlineno, code.co_name)
+
+        serializer = self.dispatcher.data_serializer.__class__
+        serializing = set(key(getattr(serializer, name).__func__.__code__)
+                          for name in self.serializer_methods if hasattr(serializer, name))
+        user = set()
+        if function is not None:
+            code = getattr(getattr(function.function, "__func__", function.function), "__code__", None)
+            if code is not None:
+                user.add(key(code))
+        dispatch = key(self.dispatcher.__class__.dispatch.__func__.__code__)
+
+        times = {"total": 0.0, "serialization": 0.0, "user": 0.0}
+        for entry, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if entry == dispatch:
+                times["total"] += ct
+            elif entry in serializing:
+                times["serialization"] += ct
+            elif entry in user:
+                times["user"] += ct
+        times["other"] = max(0.0, times["total"] - times["serialization"] - times["user"])
+        return dict((name + "_ms", round(seconds * 1000, 3)) for name, seconds in times.items())
+
+
+#=========================================
+# dispatcher
+
+class AsyncResult:
+    """Result of a RPC-function which is completed later.
+
+    A RPC-function which would block (e.g. while waiting for I/O) can
+    return an AsyncResult and complete it later by calling set_result()
+    or set_exception(), from any thread. Event-loop servers keep serving
+    other requests meanwhile, threaded servers wait for the result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._cancel_callbacks = []
+        self.result = None
+        self.exc_info = None
+        self.encoded = None         # serialized result (set_encoded_result, coalesced calls)
+
+    def set_result(self, result):
+        """Complete with the return value result."""
+        self._complete(result, None)
+
+    def set_encoded_result(self, encoded):
+        """Complete with an already serialized (json) return value."""
+        self._complete(None, None, encoded)
+
+    def set_exception(self, err, tb = None):
+        """Complete with exception err.
+
+        RPCFaults are sent to the client, other exceptions are logged and
+        result in an INTERNAL_ERROR.
+        """
+        self._complete(None, (type(err), err, tb))
+
+    def _complete(self, result, exc_info, encoded = None):
+        with self._lock:
+            if self._event.is_set():
+                raise RuntimeError("AsyncResult is already completed.")
+            self.result = result
+            self.exc_info = exc_info
+            self.encoded = encoded
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self, err = None):
+        """Complete with exception err (default RPCRequestTimeout) and call
+        the cancel callbacks, unless the result is already available.
+
+        Used when the deadline of the request has passed.
+
+        :Returns: True if cancelled
+        """
+        if err is None:
+            err = RPCRequestTimeout("Deadline exceeded.")
+        try:
+            self.set_exception(err)
+        except RuntimeError:
+            return False        # completed before
+        with self._lock:
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_cancel_callback(self, callback):
+        """Call callback(asyncresult) when cancelled, e.g. to stop the work in progress."""
+        with self._lock:
+            if not self._event.is_set():
+                self._cancel_callbacks.append(callback)
+
+    def done(self):
+        """True if the result is available."""
+        return self._event.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(asyncresult) on completion (directly if already done)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout = None):
+        """Wait for the result, returns True if it is available."""
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+
+# deadline of the request executed by the current thread
+_current = threading.local()
+
+def deadline():
+    """Return the deadline (time.time()) of the request executed by the
+    current thread, None if it has none."""
+    return getattr(_current, "deadline", None)
+
+def check_deadline():
+    """Stop a long running RPC-function whose caller has given up.
+
+    A RPC-function can not be interrupted, it should call this now and
+    then instead.
+
+    :Raises: RPCRequestTimeout if the deadline of the current request has passed
+    """
+    expires = getattr(_current, "deadline", None)
+    if expires is not None and time.time() >= expires:
+        raise RPCRequestTimeout("Deadline exceeded.")
+
+
+class DeadlineTimer:
+    """Cancels AsyncResults which are not completed before their deadline.
+
+    A single thread waits for the earliest deadline. It is started by the
+    first add() (of a process, the thread does not survive fork()).
+
+    :Variables:
+        - expired: number of cancelled AsyncResults
+    """
+    def __init__(self, name = "DeadlineTimer"):
+        self.name = name
+        self.expired = 0
+        self._pid = None
+        self._start_lock = threading.Lock()     # one _start() per process
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._deadlines = []        # heap of (deadline, seq, AsyncResult, message)
+        self._seq = 0
+        thread = threading.Thread(target = self._run, name = self.name)
+        thread.daemon = True
+        thread.start()
+        self._pid = os.getpid()     # last, add() only skips _start() when done
+
+    def add(self, deadline, result, message = "Deadline exceeded."):
+        """Cancel result with RPCRequestTimeout(message) at deadline (time.time())."""
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._deadlines, (deadline, self._seq, result, message))
+            if self._deadlines[0][2] is result:
+                self._wakeup.notify()
+
+    def _run(self):
+        with self._lock:
+            while True:
+                now = time.time()
+                expired = []
+                while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][2].done()):
+                    expired.append(heapq.heappop(self._deadlines))
+                if expired:
+                    cancelled = 0
+                    self._lock.release()
+                    try:
+                        for deadline, seq, result, message in expired:
+                            if not result.done() and result.cancel(RPCRequestTimeout(message)):
+                                cancelled += 1
+                    finally:
+                        self._lock.acquire()
+                    self.expired += cancelled
+                    continue
+                if self._deadlines:
+                    self._wakeup.wait(self._deadlines[0][0] - now)
+                else:
+                    self._wakeup.wait()
+
+
+def _settle(result):
+    """Complete result with None unless it is completed (e.g. cancelled) already."""
+    try:
+        result.set_result(None)
+    except RuntimeError:
+        pass
+
+
+def is_stream(result):
+    """True if result is an iterator or generator, which is streamed."""
+    return isinstance(result, types.GeneratorType) or \
+        (hasattr(result, "next") and hasattr(result, "__iter__"))
+
+
+class StreamedReply:
+    """Reply of a RPC-function returning an iterator or generator.
+
+    Returned by Dispatcher.dispatch instead of a string. The server sends
+    the chunks (see JsonRpc10.dumps_stream) as they are produced, so the
+    result is never materialized as a whole. Iterate only once.
+
+    :Variables:
+        - size: number of bytes produced so far
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._callbacks = []
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.size += len(chunk)
+            yield chunk
+        for callback in self._callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(streamedreply) when all chunks are produced."""
+        self._callbacks.append(callback)
+
+    def join(self):
+        """Return the complete reply as string (materializes the result)."""
+        return "".join(self)
+
+
+class WorkerPool:
+    """Fixed number of worker threads executing jobs from a bounded queue.
+
+    When the queue is full, submit() fails immediately instead of letting
+    the queue (and the memory) grow without limit.
+
+    With a shed_target, load is shed before the queue is full: a job is
+    rejected if it would wait longer than shed_target for a worker,
+    estimated from the queue depth and the (moving) average duration of
+    the jobs. The queue then holds only the jobs which can be started in
+    time, instead of adding the same delay to every request.
+    """
+    # weight of the last job in the moving average of the job duration
+    duration_weight = 0.1
+
+    def __init__(self, workers, queue_size, shed_target = None, logger = None):
+        """init
+
+        :Parameters:
+            - workers:     number of worker threads
+            - queue_size:  maximum number of waiting jobs (at least 1)
+            - shed_target: acceptable queueing delay in seconds, None to
+                           reject jobs only when the queue is full
+            - logger:      AsyncLogger for the exceptions of the jobs, the
+                           Dispatcher using the pool sets its own; default
+                           a shared AsyncLogger
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.shed_target = shed_target
+        self.logger = logger
+        self._start_lock = threading.Lock()     # one _start() per process
+        self.busy = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.duration = 0.0         # moving average of the job duration
+        self._start()
+
+    def _start(self):
+        # also called in a forked child (e.g. by ForkingTCPServer), the
+        # threads do not survive fork(); the jobs queued in the parent
+        # are not ours
+        self.queue = Queue.Queue(self.queue_size)
+        self._lock = threading.Lock()   # may have been held by a thread of the parent
+        self.busy = 0
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target = self._work, name = "WorkerPool-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self._pid = os.getpid()
+
+    def logfile(self, message):
+        (self.logger or default_logger()).log(message)
+
+    def submit(self, function, *args):
+        """Queue the job function(*args).
+
+        :Raises: RPCServerBusy if the queue is full or load is shed
+        """
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        if self.shed_target is not None and self.expected_wait() > self.shed_target:
+            with self._lock:
+                self.rejected += 1
+                self.shed += 1
+            raise RPCServerBusy("Overloaded, queueing delay above %d ms." % (self.shed_target * 1000))
+        try:
+            self.queue.put_nowait((time.time(), function, args))
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise RPCServerBusy("Request queue is full.")
+        with self._lock:
+            self.submitted += 1
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            enqueued, function, args = job
+            started = time.time()
+            wait = started - enqueued
+            with self._lock:
+                self.busy += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                function(*args)
+            except Exception:
+                (self.logger or default_logger()).log_exception(sys.exc_info())
+            duration = time.time() - started
+            with self._lock:
+                self.busy -= 1
+                self.completed += 1
+                self.duration += (duration - self.duration) * self.duration_weight
+
+    def expected_wait(self):
+        """Estimated seconds a job submitted now waits for a worker."""
+        return self.queue.qsize() * self.duration / self.workers
+
+    def stats(self):
+        """Usage of the pool, to size workers and queue_size.
+
+        :Returns: dict with the number of workers, busy workers, queue
+                  depth and size, submitted/rejected/completed jobs (the
+                  rejected include the shed ones), the average and maximum
+                  queue wait time and the expected wait time in milliseconds
+        """
+        with self._lock:
+            started = self.completed + self.busy
+            return {
+                "workers"     : self.workers,
+                "busy"        : self.busy,
+                "queue_depth" : self.queue.qsize(),
+                "queue_size"  : self.queue_size,
+                "submitted"   : self.submitted,
+                "rejected"    : self.rejected,
+                "shed"        : self.shed,
+                "completed"   : self.completed,
+                "wait_avg_ms" : 1000.0 * self.wait_total / started if started else 0.0,
+                "wait_max_ms" : 1000.0 * self.wait_max,
+                "expected_wait_ms": 1000.0 * self.expected_wait(),
+            }
+
+    def shutdown(self, timeout = None):
+        """Stop the workers after the queued jobs.
+
+        :Parameters:
+            - timeout: seconds to wait for the workers to finish, None to
+                       return at once
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        if timeout is None:
+            return
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+
+
+class ProcessError(Exception):
+    """Exception raised by a RPC-function in a worker process of a ProcessPool.
+
+    The message is the formatted traceback from the worker process.
+    """
+
+
+# registry of the worker processes of a ProcessPool, inherited by fork()
+_process_functions = {}
+_process_dumps = None
+
+def _process_init(functions, dumps):
+    global _process_functions, _process_dumps
+    _process_functions = functions
+    _process_dumps = dumps
+    # Ctrl-C reaches the whole process group, the server stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _process_call(name, args, kwargs, expires = None):
+    """Execute a RPC-function in a worker process.
+
+    Only pickle-friendly tuples are sent back: the result is serialized to
+    json here, so the server only has to splice it into the reply. A call
+    whose deadline expires passed while it was queued is not executed.
+    """
+    _current.deadline = expires
+    try:
+        check_deadline()
+        result = _process_functions[name](*args, **kwargs)
+    except RPCFault, err:
+        return ("fault", err.error_code, err.error_message, err.error_data)
+    except Exception:
+        return ("exception", traceback.format_exc())
+    if isinstance(result, dict) and "error" in result:
+        return ("value", result)
+    try:
+        if is_stream(result):
+            result = list(result)   # generators can not be sent to the server
+        return ("encoded", _process_dumps(result))
+    except Exception:
+        return ("exception", traceback.format_exc())
+
+
+class ProcessPool:
+    """Worker processes executing the cpu_bound RPC-functions.
+
+    CPU-bound functions executed by threads serialize on the GIL and
+    starve the cheap calls. The Dispatcher sends the calls of functions
+    registered as cpu_bound to this pool instead, and gets an AsyncResult
+    completed with the result serialized by the worker.
+
+    The pool is started by Dispatcher.freeze(): the workers are forked
+    with the complete registry, so only the name of the function and the
+    parameters are sent to them. In a process forked from the server
+    afterwards (e.g. by ForkingTCPServer), the functions are executed
+    in-process, that process already runs on its own core.
+
+    :Variables:
+        - processes:  number of worker processes
+        - timeout:    seconds after which a call is answered with
+                      REQUEST_TIMEOUT, None to wait forever. The
+                      deadline of the request (see Dispatcher) applies as
+                      well. The worker is not interrupted, it finishes
+                      the call (unless it calls check_deadline()); calls
+                      which are still queued at their deadline are skipped.
+        - queue_size: maximum number of calls in progress, further calls
+                      are rejected with SERVER_BUSY. A call stops counting
+                      when it is answered, also by a timeout: the call of
+                      a worker that died (e.g. killed by the OOM killer)
+                      never completes, only the timeout frees its place.
+    """
+    def __init__(self, processes = None, timeout = 30, queue_size = None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if queue_size is None:
+            queue_size = processes * 64
+        self.processes = processes
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.functions = {}
+        self.pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._timer = DeadlineTimer("ProcessPool-timeouts")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self, functions, dumps):
+        """Fork the workers.
+
+        :Parameters:
+            - functions: dict name -> function of the cpu_bound functions
+            - dumps:     json serializer of the results
+        """
+        self.functions = functions
+        self._pid = os.getpid()
+        self.pool = multiprocessing.Pool(self.processes, _process_init, (functions, dumps))
+
+    def function(self, name):
+        """Return a callable executing function name in the pool."""
+        return lambda *args, **kwargs: self.call(name, args, kwargs)
+
+    def call(self, name, args, kwargs):
+        """Execute function name in a worker.
+
+        :Returns: AsyncResult
+        :Raises:  RPCServerBusy if queue_size calls are in progress
+        """
+        if os.getpid() != self._pid:
+            return self.functions[name](*args, **kwargs)
+
+        with self._lock:
+            if self.pending >= self.queue_size:
+                self.rejected += 1
+                raise RPCServerBusy("Process pool queue is full.")
+            self.pending += 1
+        expires = deadline()
+        message = "Deadline exceeded."
+        if self.timeout is not None and (expires is None or time.time() + self.timeout < expires):
+            expires = time.time() + self.timeout
+            message = "Timeout after %s seconds." % self.timeout
+        result = AsyncResult()
+        released = []
+
+        def release(result = None):
+            # once per call, on completion or cancellation (timeout)
+            with self._lock:
+                if not released:
+                    released.append(True)
+                    self.pending -= 1
+
+        result.add_cancel_callback(release)
+        self.pool.apply_async(_process_call, (name, args, kwargs, expires),
+                              callback = lambda outcome: self._done(result, outcome, release))
+        if expires is not None:
+            self._timer.add(expires, result, message)
+        return result
+
+    def _done(self, result, outcome, release):
+        # called by the result thread of the multiprocessing pool
+        release()
+        with self._lock:
+            self.completed += 1
+        try:
+            if outcome[0] == "encoded":
+                result.set_encoded_result(outcome[1])
+            elif outcome[0] == "value":
+                result.set_result(outcome[1])
+            elif outcome[0] == "fault":
+                result.set_exception(RPCFault(*outcome[1:]))
+            else:
+                result.set_exception(ProcessError(outcome[1]))
+        except RuntimeError:
+            pass            # timed out before
+
+    def stats(self):
+        """Return a dict with processes, pending, completed, rejected and timeouts."""
+        with self._lock:
+            return {"processes": self.processes, "pending": self.pending, "completed": self.completed,
+                    "rejected": self.rejected, "timeouts": self._timer.expired}
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+class ResultCache:
+    """LRU cache of the serialized results of a RPC-function.
+
+    Declared at registration (see Dispatcher.register_function) for pure
+    or slowly changing functions. The key is the method name plus the
+    parameters; a hit returns the serialized result without calling the
+    function or encoding the result again.
+
+    :Variables:
+        - ttl:         seconds a result is valid
+        - max_entries: maximum number of cached results, the least
+                       recently used result is evicted first
+    """
+    def __init__(self, ttl, max_entries = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # key -> (expires, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the serialized result of key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[key] = entry          # most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result):
+        """Store the serialized result of key."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def stats(self):
+        """Return a dict with entries, hits and misses."""
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class Method:
+    """A registered RPC-function with its precomputed signature.
+
+    The signature is inspected once at registration, so calls with a wrong
+    number or wrong names of parameters are rejected without calling the
+    function. Functions whose signature can not be inspected (builtins)
+    are not checked.
+    """
+    def __init__(self, function, name, cache = None, coalesce = False, stats = None, cpu_bound = False,
+                 timeout = None):
+        self.function = function
+        self.name = name
+        self.cache = cache          # ResultCache or None
+        self.coalesce = coalesce    # share concurrent identical calls
+        self.stats = stats          # MethodStats or None
+        self.cpu_bound = cpu_bound  # executed in the ProcessPool
+        self.timeout = timeout      # default seconds until the deadline, or None
+        self.args = None            # None: unknown signature
+
+        target = function
+        if not (inspect.isfunction(target) or inspect.ismethod(target)):
+            target = getattr(function, "__call__", None)
+        try:
+            spec = inspect.getargspec(target)
+        except TypeError:
+            return
+
+        args = spec.args
+        if inspect.ismethod(target) and target.__self__ is not None:
+            args = args[1:]         # bound: without self
+        self.args = tuple(args)
+        self.min_args = len(args) - len(spec.defaults or ())
+        self.max_args = None if spec.varargs else len(args)
+        self.required = frozenset(args[:self.min_args])
+        self.keywords = spec.keywords is not None
+
+    def deadline(self, received, timeout):
+        """Return the deadline of a call, None if it has none.
+
+        :Parameters:
+            - received: time.time() when the request was received
+            - timeout:  the timeout of the request, or None
+        """
+        if timeout is None or (self.timeout is not None and self.timeout < timeout):
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return received + timeout
+
+    def check(self, params):
+        """Check the parameters against the signature.
+
+        :Raises: RPCInvalidMethodParams
+        """
+        if self.args is None:
+            return
+
+        if isinstance(params, dict):
+            missing = self.required.difference(params)
+            if missing:
+                raise RPCInvalidMethodParams("Missing parameter(s): %s." % ", ".join(sorted(missing)))
+            if not self.keywords:
+                unknown = set(params).difference(self.args)
+                if unknown:
+                    raise RPCInvalidMethodParams("Unknown parameter(s): %s." % ", ".join(sorted(unknown)))
+
+        elif len(params) < self.min_args or (self.max_args is not None and len(params) > self.max_args):
+            if self.max_args is None:
+                expected = "at least %d" % self.min_args
+            elif self.min_args == self.max_args:
+                expected = "%d" % self.min_args
+            else:
+                expected = "%d to %d" % (self.min_args, self.max_args)
+            raise RPCInvalidMethodParams("%s takes %s parameter(s) (%d given)." % (self.name, expected, len(params)))
+
+
+class Dispatcher:
+    """Registry of RPC-functions and dispatcher of RPC-requests.
+
+    The dispatcher is independent of the transport and is used by all
+    server engines. The registry is meant to be built once per process at
+    startup and shared by all connections: after freeze() it can not be
+    changed anymore.
+
+    RPC-functions may return an iterator or generator, the result is then
+    streamed as JSON array (see StreamedReply).
+
+    A request may have a deadline: the "timeout" of the request (seconds
+    the client waits, counted from the reception of the request) or the
+    timeout of the function, whichever is shorter. A request which was
+    queued beyond its deadline is answered with REQUEST_TIMEOUT without
+    executing it, an AsyncResult still pending at the deadline is
+    cancelled. Long running functions can check_deadline().
+    """
+    # minimal size of the chunks of a streamed result
+    stream_chunk_size = 65536
+
+    def __init__(self, data_serializer = None, batch_pool = None, stats = None, logger = None,
+                 process_pool = None, profiler = None):
+        """init
+
+        :Parameters:
+            - data_serializer: the serializer, JsonRpc10 if omitted
+            - batch_pool:      WorkerPool executing the entries of a batch
+                               in parallel, if omitted they are executed
+                               one after the other. Use a dedicated pool:
+                               its jobs must not wait for other jobs.
+            - stats:           Stats instance to instrument the dispatching,
+                               served as RPC-method "system.stats"
+            - logger:          AsyncLogger, if omitted messages are printed
+                               synchronously
+            - process_pool:    ProcessPool executing the cpu_bound functions,
+                               started by freeze(). If omitted, they are
+                               executed in-process like the others.
+            - profiler:        Profiler, served as RPC-methods system.profile.*
+        """
+        if data_serializer is None:
+            data_serializer = JsonRpc10()
+        self.data_serializer = data_serializer
+        self.batch_pool = batch_pool
+        self.funcs = {}             # name -> Method
+        self.frozen = False
+        self._inflight = {}         # key -> AsyncResult of a coalesced call
+        self._inflight_lock = threading.Lock()
+        self.deadlines = DeadlineTimer()
+        self.stats = stats
+        self.logger = logger
+        if batch_pool is not None and batch_pool.logger is None:
+            batch_pool.logger = logger
+        self.process_pool = process_pool
+        if stats is not None:
+            self.register_function(stats.report, name = "system.stats")
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+
+    def logfile(self, message):
+        if self.logger is not None:
+            self.logger.log(message)
+        else:
+            print(message)
+
+    def log_payload(self, prefix, data):
+        """Log request or reply data (sampled and truncated by the logger)."""
+        if self.logger is not None:
+            self.logger.log_payload(prefix, data)
+        else:
+            self.logfile(prefix + data)
+
+    def log_reply(self, reply):
+        """Log a reply like log_payload, a StreamedReply when it is produced completely."""
+        if isinstance(reply, StreamedReply):
+            reply.add_done_callback(
+                lambda reply: self.log_payload("Reply: ", "(streamed, %d bytes)" % reply.size))
+        elif reply is not None:
+            self.log_payload("Reply: ", reply)
+
+    def log_exception(self, exc_info):
+        """Log an unexpected exception (from sys.exc_info()) with traceback."""
+        if self.logger is not None:
+            self.logger.log_exception(exc_info)
+            return
+        exc_type, exc_value, exc_traceback = exc_info
+        self.logfile("%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(exc_value)))
+        self.logfile(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+
+    def register_instance(self, myinst, name = None, cache = None, coalesce = (), cpu_bound = (), timeout = None):
+        """Add all functions of a class-instance to the RPC-services.
+
+        All entries of the instance which do not begin with '_' are added.
+
+        :Parameters:
+            - myinst: class-instance containing the functions
+            - name:   | hierarchical prefix.
+                      | If omitted, the functions are added directly.
+                      | If given, the functions are added as "name.function".
+            - cache:  dict of function name (without prefix) -> ResultCache
+            - coalesce: names of the functions (without prefix) whose
+                      concurrent identical calls are coalesced
+            - cpu_bound: names of the functions (without prefix) which are
+                      executed in the process_pool
+            - timeout: dict of function name (without prefix) -> seconds
+                      until the deadline of its calls
+        :TODO:
+            - only add functions and omit attributes?
+            - improve hierarchy?
+        """
+        if cache is None:
+            cache = {}
+        if timeout is None:
+            timeout = {}
+        for e in dir(myinst):
+            if e[0][0] != "_":
+                if name is None:
+                    self.register_function(getattr(myinst, e), cache = cache.get(e),
+                                           coalesce = e in coalesce, cpu_bound = e in cpu_bound,
+                                           timeout = timeout.get(e))
+                else:
+                    self.register_function(getattr(myinst, e), name="%s.%s" % (name, e), cache = cache.get(e),
+                                           coalesce = e in coalesce, cpu_bound = e in cpu_bound,
+                                           timeout = timeout.get(e))
+
+    def register_function(self, function, name = None, cache = None, coalesce = False, cpu_bound = False,
+                          timeout = None):
+        """Add a function to the RPC-services.
+
+        :Parameters:
+            - function: function to add
+            - name:     RPC-name for the function. If omitted/None, the original
+                        name of the function is used.
+            - cache:    ResultCache for the results of the function, None
+                        to call the function for every request
+            - coalesce: if True, concurrent calls with identical params
+                        share one execution of the function and every
+                        caller gets a copy of the result with its own id.
+                        Prevents stampedes on the backing data stores.
+            - cpu_bound: if True, the function is executed in the
+                        process_pool, so it does not hold the GIL of the
+                        server. Parameters and result must be picklable.
+            - timeout:  seconds until the deadline of a call (also if the
+                        request has no or a longer timeout), None for no
+                        deadline
+        :Raises:    RuntimeError if the dispatcher is frozen
+        """
+        if self.frozen:
+            raise RuntimeError("Dispatcher is frozen, functions must be registered at startup.")
+        if name is None:
+            name = function.__name__
+        stats = None
+        if self.stats is not None:
+            stats = self.stats.method(name, cache)
+        self.funcs[name] = Method(function, name, cache, coalesce, stats, cpu_bound, timeout)
+
+    def freeze(self):
+        """Make the registry immutable and start the process_pool, returns self."""
+        if self.frozen:
+            return self
+        self.frozen = True
+        cpu_bound = [method for method in self.funcs.values() if method.cpu_bound]
+        if self.process_pool is not None and cpu_bound:
+            self.process_pool.start(dict((method.name, method.function) for method in cpu_bound),
+                                    self.data_serializer.dumps)
+            for method in cpu_bound:
+                method.function = self.process_pool.function(method.name)
+        return self
+
+    def dispatch(self, rpcstr, callback = None, received = None):
+        """Handle a RPC-Request or a batch (array) of RPC-Requests.
+
+        The entries of a batch are executed in the batch_pool (if any) and
+        the replies are sent back in one array.
+
+        :Parameters:
+            - rpcstr:   the received rpc-string
+            - callback: | only used if the function returns an AsyncResult.
+                        | If omitted, dispatch waits for the result.
+                        | If given, dispatch returns the AsyncResult and
+                          callback(reply) is called on completion (from the
+                          completing thread, maybe before dispatch returns).
+            - received: time.time() when the request was received, the
+                        deadline counts from here. Default now, pass it
+                        if the request was queued.
+        :Returns: the data to send back (a string or a StreamedReply) or
+                  None if nothing should be sent back
+        :Raises:  RPCFault (and maybe others)
+        """
+        if received is None:
+            received = time.time()
+        stats = self.stats
+        if stats is None:
+            return self._dispatch(rpcstr, callback, received)
+
+        stats.received(len(rpcstr))
+        if callback is not None:
+            callback = stats.sending(callback)
+        reply = self._dispatch(rpcstr, callback, received)
+        if isinstance(reply, AsyncResult):
+            return reply
+        return stats.sent(reply)
+
+    def _dispatch(self, rpcstr, callback, received):
+        """Parse and execute a request, see dispatch."""
+        started = time.time()
+        try:
+            requests, batch = self.data_serializer.loads_batch(rpcstr)
+
+        except RPCFault, err:
+            if self.stats is not None:
+                self.stats.error(err.error_code)
+            return self.data_serializer.dumps_error(err, id = None)
+
+        except Exception, err:
+            self.log_exception(sys.exc_info())
+            if self.stats is not None:
+                self.stats.error(INTERNAL_ERROR)
+            return self.data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id = None)
+
+        if self.stats is not None:
+            self.stats.parsed(time.time() - started)
+
+        if not batch:
+            return self._call(requests[0], callback, received)
+
+        result = self._call_batch(requests, received)
+        if callback is not None and not result.done():
+            result.add_done_callback(lambda r: callback(r.result))
+            return result
+        result.wait()
+        return result.result
+
+    def error_reply(self, rpcstr, err):
+        """Reply err to a request without executing it (e.g. when rejected).
+
+        The request is only de-serialized to tag the error(s) with the id,
+        so that pipelining clients can match them.
+
+        :Parameters:
+            - rpcstr: the received rpc-string
+            - err:    a RPCFault instance
+        """
+        if self.stats is not None:
+            self.stats.received(len(rpcstr))
+            self.stats.error(err.error_code)
+            return self.stats.sent(self._error_reply(rpcstr, err))
+        return self._error_reply(rpcstr, err)
+
+    def _error_reply(self, rpcstr, err):
+        """Serialize the error reply, see error_reply."""
+        try:
+            requests, batch = self.data_serializer.loads_batch(rpcstr)
+        except Exception:
+            return self.data_serializer.dumps_error(err, id = None)
+
+        replies = []
+        for req in requests:
+            if isinstance(req, RPCFault):
+                replies.append(self.data_serializer.dumps_error(req, id = None))
+            else:
+                replies.append(self.data_serializer.dumps_error(err, req[2]))
+        if not batch:
+            return replies[0] if replies else None
+        return self.data_serializer.dumps_batch(replies)
+
+    def _call(self, req, callback, received):
+        """Execute a single de-serialized request, see dispatch."""
+        if isinstance(req, RPCFault):       # invalid entry of a batch
+            if self.stats is not None:
+                self.stats.error(req.error_code)
+            return self.data_serializer.dumps_error(req, id = None)
+
+        notification = False
+        timeout = None
+        if len(req) == 2:       #notification
+            method, params = req
+            notification = True
+        else:                   #request
+            method, params, id, timeout = req
+
+        function = self.funcs.get(method)
+        if function is None:
+            if self.stats is not None:
+                self.stats.error(METHOD_NOT_FOUND)
+            if notification:
+                return None
+            return self.data_serializer.dumps_error( RPCFault(METHOD_NOT_FOUND, ERROR_MESSAGE[METHOD_NOT_FOUND]), id )
+
+        if function.stats is not None:
+            function.stats.called()
+        expires = function.deadline(received, timeout)
+        if expires is not None and time.time() >= expires:
+            # queued too long, the client does not wait for the reply anymore
+            err = RPCRequestTimeout("Deadline exceeded before execution.")
+            return self._reply(None, (RPCRequestTimeout, err, None), id, notification, function = function)
+        try:
+            function.check(params)
+        except RPCFault, err:
+            reply = None
+            if not notification:
+                reply = self.data_serializer.dumps_error(err, id)
+            if function.stats is not None:
+                function.stats.replied(err.error_code, reply)
+            return reply
+
+        key = None
+        if function.cache is not None or function.coalesce:
+            key = (method, self.data_serializer.dumps(params))
+        if function.cache is not None:
+            cached = function.cache.get(key)
+            if cached is not None:
+                reply = None
+                if not notification:
+                    reply = self.data_serializer.dumps_raw_response(cached, id)
+                if function.stats is not None:
+                    function.stats.replied(None, reply)
+                return reply
+
+        if function.coalesce:
+            return self._call_coalesced(function, params, key, id, notification, callback, expires)
+
+        started = time.time()
+        try:
+            result = self._execute(function, params, expires)
+
+        except Exception:
+            return self._finish(function, key, None, sys.exc_info(), id, notification, started)
+
+        if isinstance(result, AsyncResult):
+            self._expire(function, result, expires)
+            if callback is not None:
+                result.add_done_callback(
+                    lambda r: callback(self._finish(function, key, r.result, r.exc_info, id, notification,
+                                                    started, r.encoded)))
+                return result
+            result.wait()
+            return self._finish(function, key, result.result, result.exc_info, id, notification,
+                                started, result.encoded)
+
+        return self._finish(function, key, result, None, id, notification, started)
+
+    def _execute(self, function, params, expires):
+        """Call the RPC-function, with the deadline expires for check_deadline()."""
+        previous = getattr(_current, "deadline", None)
+        _current.deadline = expires
+        try:
+            if isinstance(params, dict):
+                return function.function(**params)
+            return function.function(*params)
+        finally:
+            _current.deadline = previous
+
+    def _expire(self, function, result, expires):
+        """Cancel the AsyncResult of a call if it is still pending at the deadline expires."""
+        if expires is None or result.done():
+            return
+        if function.cpu_bound and self.process_pool is not None:
+            return          # the process pool applies the deadline itself
+        self.deadlines.add(expires, result)
+
+    def _call_coalesced(self, function, params, key, id, notification, callback, expires = None):
+        """Execute a request of a coalescing function, see _call.
+
+        The first request of a key executes the function, identical
+        requests arriving meanwhile wait for its (once serialized) result.
+        The deadline of the first request applies to the shared execution.
+        """
+        with self._inflight_lock:
+            shared = self._inflight.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._inflight[key] = AsyncResult()
+
+        if leader:
+            started = time.time()
+            try:
+                result = self._execute(function, params, expires)
+
+            except Exception:
+                self._share(function, key, shared, None, sys.exc_info(), started)
+            else:
+                if isinstance(result, AsyncResult):
+                    self._expire(function, result, expires)
+                    result.add_done_callback(
+                        lambda r: self._share(function, key, shared, r.result, r.exc_info, started, r.encoded))
+                else:
+                    self._share(function, key, shared, result, None, started)
+
+        reply = lambda r: self._reply(r.result, r.exc_info, id, notification, r.encoded, function)
+        if callback is not None and not shared.done():
+            shared.add_done_callback(lambda r: callback(reply(r)))
+            return shared
+        shared.wait()
+        return reply(shared)
+
+    def _share(self, function, key, shared, result, exc_info, started, encoded = None):
+        """Complete the shared execution of a coalesced call."""
+        if function.stats is not None:
+            function.stats.executed(time.time() - started)
+        if exc_info is None and is_stream(result):
+            # a generator can not be shared, all waiters get the complete result
+            try:
+                result = list(result)
+            except Exception:
+                result, exc_info = None, sys.exc_info()
+        shared.encoded = self._encode(function, key, result, exc_info, encoded)
+        with self._inflight_lock:
+            del self._inflight[key]
+        if exc_info is not None:
+            shared.set_exception(exc_info[1], exc_info[2])
+        elif shared.encoded is not None:
+            shared.set_encoded_result(shared.encoded)
+        else:
+            shared.set_result(result)
+
+    def _finish(self, function, key, result, exc_info, id, notification, started, encoded = None):
+        """Serialize the outcome of a RPC-function, storing it in its cache.
+
+        :Parameters:
+            - started: time.time() when the function was called
+            - encoded: the result if already serialized (AsyncResult.encoded)
+        """
+        if function.stats is not None:
+            function.stats.executed(time.time() - started)
+        if function.cache is not None:
+            encoded = self._encode(function, key, result, exc_info, encoded)
+        return self._reply(result, exc_info, id, notification, encoded, function)
+
+    def _encode(self, function, key, result, exc_info, encoded = None):
+        """Serialize a successful result once and store it in the cache.
+
+        :Returns: the serialized result, None for errors
+        """
+        if exc_info is not None or (isinstance(result, dict) and "error" in result) or is_stream(result):
+            return None
+        if encoded is None:
+            try:
+                encoded = self.data_serializer.dumps(result)
+            except Exception:
+                return None     # not serializable, reported by dumps_response
+        if function.cache is not None:
+            function.cache.put(key, encoded)
+        return encoded
+
+    def _call_batch(self, requests, received):
+        """Execute the entries of a batch, in parallel if there is a batch_pool.
+
+        :Returns: AsyncResult of the serialized batch reply
+        """
+        replies = [None] * len(requests)
+        answered = [False] * len(requests)
+        remaining = [len(requests)]
+        lock = threading.Lock()
+        batch_result = AsyncResult()
+
+        def done(i, reply):
+            # once per entry: by the call, or by the deadline of a queued entry
+            with lock:
+                if answered[i]:
+                    return
+                answered[i] = True
+            if isinstance(reply, StreamedReply):
+                reply = reply.join()    # the batch reply is sent as a whole
+            replies[i] = reply
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                batch_result.set_result(self.data_serializer.dumps_batch(
+                    [reply for reply in replies if reply is not None]))
+
+        def call(i, req, entry = None):
+            reply = self._call(req, lambda reply: done(i, reply), received)
+            if not isinstance(reply, AsyncResult):
+                done(i, reply)
+            if entry is not None:
+                _settle(entry)          # answered, drop the deadline
+
+        for i, req in enumerate(requests):
+            # the last entry (or every entry without free pool capacity)
+            # is executed by the calling thread
+            if self.batch_pool is not None and i < len(requests) - 1:
+                entry = self._batch_deadline(req, received, lambda reply, i = i: done(i, reply))
+                try:
+                    self.batch_pool.submit(call, i, req, entry)
+                    continue
+                except RPCFault:
+                    if entry is not None:
+                        _settle(entry)
+            call(i, req)
+
+        return batch_result
+
+    def _batch_deadline(self, req, received, reply_callback):
+        """Answer a batch entry given to the batch_pool at its deadline.
+
+        The batch reply waits for all entries; an entry the pool does not
+        answer in time is answered with REQUEST_TIMEOUT instead.
+
+        :Returns: AsyncResult cancelled at the deadline, None if the entry
+                  has no deadline
+        """
+        if isinstance(req, RPCFault):
+            return None
+        method, params, id, timeout = req
+        function = self.funcs.get(method)
+        if function is None:
+            return None
+        expires = function.deadline(received, timeout)
+        if expires is None:
+            return None
+
+        def expired(entry):
+            err = entry.exc_info[1]
+            reply = None if id is None else self.data_serializer.dumps_error(err, id)
+            if function.stats is not None:
+                function.stats.replied(err.error_code, reply)
+            reply_callback(reply)
+
+        entry = AsyncResult()
+        entry.add_cancel_callback(expired)
+        self.deadlines.add(expires, entry, "Deadline exceeded before the reply.")
+        return entry
+
+    def _reply(self, result, exc_info, id, notification, encoded = None, function = None):
+        """Serialize the outcome of a RPC-function.
+
+        :Parameters:
+            - result:   the return value of the function
+            - exc_info: sys.exc_info() of the raised exception or None
+            - encoded:  the already serialized result, if available
+            - function: the Method, its stats count the reply
+        """
+        if function is None or function.stats is None:
+            return self._serialize(result, exc_info, id, notification, encoded)
+
+        started = time.time()
+        reply = self._serialize(result, exc_info, id, notification, encoded)
+        seconds = time.time() - started
+        if isinstance(reply, StreamedReply):
+            seconds = None      # serialized while sending
+        if exc_info is not None:
+            code = exc_info[1].error_code if isinstance(exc_info[1], RPCFault) else INTERNAL_ERROR
+        elif isinstance(result, dict) and "error" in result:
+            code = APPLICATION_ERROR
+        else:
+            code = None
+        function.stats.replied(code, reply, seconds)
+        return reply
+
+    def _serialize(self, result, exc_info, id, notification, encoded):
+        """Serialize the outcome of a RPC-function, see _reply."""
+        if notification:
+            if exc_info is None and is_stream(result):
+                try:
+                    for item in result:     # execute the generator
+                        pass
+                except Exception:
+                    self.log_exception(sys.exc_info())
+            return None
+
+        if encoded is not None:
+            return self.data_serializer.dumps_raw_response(encoded, id)
+
+        if exc_info is not None:
+            if isinstance(exc_info[1], RPCFault):
+                return self.data_serializer.dumps_error(exc_info[1], id)
+            self.log_exception(exc_info)
+            return self.data_serializer.dumps_error(RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id)
+
+        if is_stream(result):
+            return StreamedReply(self.data_serializer.dumps_stream(result, id, self.stream_chunk_size,
+                                                                   self.log_exception))
+
+        try:
+            return self.data_serializer.dumps_response(result, id)
+
+        except Exception, err:
+            self.log_exception(sys.exc_info())
+            return self.data_serializer.dumps_error(RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id)
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+
+"""
+Load generator and benchmark harness for the JSON-RPC test server.
+
+Drives a server over loopback with concurrent clients and reports the
+throughput (requests per second) and the p50/p95/p99 latency.
+
+Single run against a running server:
+
+    loadgen.py -p 3000 -c 16 -d 10 --mix test.Test=8,test.Lookup=2 -s 1024
+
+Comparison of the server engines of test.py, every engine is started on
+a free port, loaded and stopped. The results can be stored as baseline and
+later runs compared against it; a run which is slower than the baseline by
+more than the tolerance is reported and exits with status 1:
+
+    loadgen.py --compare thread,async,pool,prefork --save baseline.json
+    loadgen.py --compare thread,async,pool,prefork --baseline baseline.json
+
+baseline.json holds the results of all engines on a single core machine,
+measured with:
+
+    loadgen.py --compare tcp,fork,thread,async,pool,prefork,epoll -c 16 -d 5 \
+        --mix test.Test=8,test.Lookup=2 -s 256 --save baseline.json
+
+A baseline is only comparable on the same hardware; measure a new one
+before comparing on another machine.
+
+Usage: loadgen.py [options]
+"""
+
+import errno
+import json
+import optparse
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import jsonrpc
+
+# engines of test.py; the single threaded TCPServer serves one connection
+# at a time, so its clients open a new connection per request
+MODES = ("tcp", "fork", "thread", "async", "pool", "prefork", "epoll")
+NO_REUSE_MODES = ("tcp",)
+
+
+def make_params(method, size):
+    """Return the parameters of a request of method with a payload of about size bytes."""
+    if method == "test.Test":
+        return ["x" * (size // 2), "y" * (size - size // 2)]
+    if method == "test.Lookup":
+        return ["key%d" % random.randint(0, 99)]
+    if method == "test.Sleep":
+        return [0.001]
+    return []
+
+
+def parse_mix(mix):
+    """Parse "method=weight,..." into a list of methods to pick from at random."""
+    methods = []
+    for entry in mix.split(","):
+        name, _, weight = entry.partition("=")
+        methods.extend([name.strip()] * int(weight or 1))
+    return methods
+
+
+class Client:
+    """Blocking client connection sending one request at a time."""
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.decoder = None
+
+    def connect(self):
+        if isinstance(self.address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.address)
+        else:
+            self.sock = socket.create_connection(self.address, self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.decoder = jsonrpc.JsonFrameDecoder(None)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def call(self, request):
+        """Send a serialized request, return the serialized reply."""
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(request)
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                raise jsonrpc.RPCTransportError("Connection closed by server.")
+            frames = self.decoder.feed(data)
+            if frames:
+                return frames[0]
+
+
+class LoadGenerator:
+    """Runs concurrency client threads for duration seconds.
+
+    :Variables:
+        - latencies: seconds of every request after the warmup
+        - errors:    number of error replies and failed requests
+    """
+
+    def __init__(self, address, concurrency = 16, duration = 10.0, warmup = 1.0,
+                 methods = ("test.Test",), payload_size = 16, reuse = True, timeout = 10.0):
+        self.address = address
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.methods = methods
+        self.payload_size = payload_size
+        self.reuse = reuse
+        self.timeout = timeout
+        self.serializer = jsonrpc.JsonRpc10()
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Generate the load, returns the result dict (see result)."""
+        start = time.time()
+        self.measure_from = start + self.warmup
+        self.stop_at = self.measure_from + self.duration
+        threads = [threading.Thread(target = self._client, args = (i,)) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.result()
+
+    def _client(self, number):
+        # the requests are built in advance, so the client measures the server
+        requests = [self.serializer.dumps_request(method, make_params(method, self.payload_size), number)
+                    for method in self.methods]
+        client = Client(self.address, self.timeout)
+        latencies = []
+        errors = 0
+        while True:
+            request = random.choice(requests)
+            started = time.time()
+            if started >= self.stop_at:
+                break
+            try:
+                reply = client.call(request)
+                failed = '"error":null' not in reply
+            except (socket.error, jsonrpc.RPCError):
+                client.close()
+                failed = True
+            ended = time.time()
+            if not self.reuse:
+                client.close()
+            if started >= self.measure_from:
+                latencies.append(ended - started)
+                errors += failed
+        client.close()
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+
+    def result(self):
+        """Return requests, errors, rps and the p50/p95/p99 latency in ms."""
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * q / 100.0))] * 1000, 3)
+
+        return {"requests": len(latencies),
+                "errors": self.errors,
+                "rps": round(len(latencies) / self.duration, 1),
+                "p50_ms": percentile(50),
+                "p95_ms": percentile(95),
+                "p99_ms": percentile(99)}
+
+
+#----------------------
+# engine comparison
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(mode, address, extra_args = ()):
+    """Start test.py with engine mode, returns the process when it accepts connections.
+
+    :Parameters:
+        - address: TCP port or path of a Unix domain socket to listen on
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if isinstance(address, basestring):
+        listen = ["-u", address]
+    else:
+        listen = ["-p", str(address)]
+    args = [sys.executable, os.path.join(directory, "test.py"), "-m", mode,
+            "--log-sample", "0"] + listen + list(extra_args)
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(args, cwd = directory, stdout = devnull, stderr = devnull)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server (%s) exited with status %d." % (mode, process.returncode))
+        client = Client(address if isinstance(address, basestring) else ("127.0.0.1", address), 0.5)
+        try:
+            client.connect()
+            client.close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError("Server (%s) does not accept connections." % mode)
+
+
+def stop_server(process, timeout = 15):
+    """Interrupt the server (like Ctrl-C), kill it after timeout seconds."""
+    try:
+        process.send_signal(signal.SIGINT)
+    except OSError, err:
+        if err.errno != errno.ESRCH:
+            raise
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def compare(modes, options, methods):
+    """Load every engine in modes, returns mode -> result dict."""
+    results = {}
+    for mode in modes:
+        if options.unix:
+            address = listen = options.unix
+        else:
+            listen = free_port()
+            address = ("127.0.0.1", listen)
+        process = start_server(mode, listen, options.server_args.split())
+        try:
+            generator = LoadGenerator(address, options.concurrency, options.duration,
+                                      options.warmup, methods, options.payload_size,
+                                      options.reuse and mode not in NO_REUSE_MODES, options.timeout)
+            results[mode] = generator.run()
+        finally:
+            stop_server(process)
+        print_result(mode, results[mode])
+    return results
+
+
+def check_baseline(results, baseline, tolerance):
+    """Compare results with a stored baseline.
+
+    :Returns: list of regression descriptions, empty if there are none
+    """
+    regressions = []
+    for mode, result in sorted(results.items()):
+        base = baseline.get(mode)
+        if base is None:
+            continue
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append("%s: %.1f requests/s, baseline %.1f" % (mode, result["rps"], base["rps"]))
+        if result["p99_ms"] is not None and base["p99_ms"] is not None and \
+                result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append("%s: p99 %.3f ms, baseline %.3f ms" % (mode, result["p99_ms"], base["p99_ms"]))
+    return regressions
+
+
+def print_header():
+    print "%-10s %10s %8s %10s %10s %10s %10s" % ("mode", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+
+
+def print_result(name, result):
+    def ms(value):
+        return "-" if value is None else "%.3f" % value
+    print "%-10s %10d %8d %10.1f %10s %10s %10s" % (name, result["requests"], result["errors"], result["rps"],
+                                                     ms(result["p50_ms"]), ms(result["p95_ms"]), ms(result["p99_ms"]))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", default = "127.0.0.1", help = "server address [%default]")
+    parser.add_option("-p", "--port", type = "int", default = 3000, help = "server port [%default]")
+    parser.add_option("-u", "--unix", default = None, metavar = "PATH",
+                      help = "connect to the Unix domain socket PATH instead of TCP")
+    parser.add_option("-c", "--concurrency", type = "int", default = 16,
+                      help = "number of concurrent clients [%default]")
+    parser.add_option("-d", "--duration", type = "float", default = 10.0,
+                      help = "seconds to measure per run [%default]")
+    parser.add_option("-W", "--warmup", type = "float", default = 1.0,
+                      help = "seconds of load before measuring [%default]")
+    parser.add_option("-m", "--mix", default = "test.Test=1",
+                      help = "methods and weights, e.g. test.Test=8,test.Lookup=2,test.Sleep=1 [%default]")
+    parser.add_option("-s", "--payload-size", type = "int", default = 16,
+                      help = "bytes of parameters of test.Test [%default]")
+    parser.add_option("-n", "--no-reuse", dest = "reuse", action = "store_false", default = True,
+                      help = "open a new connection for every request")
+    parser.add_option("-t", "--timeout", type = "float", default = 10.0,
+                      help = "seconds to wait for a reply [%default]")
+    parser.add_option("-C", "--compare", default = None,
+                      help = "start and load these test.py engines one after the other: %s" % ", ".join(MODES))
+    parser.add_option("-a", "--server-args", default = "",
+                      help = "extra arguments for test.py in --compare, e.g. \"-t 32\"")
+    parser.add_option("--save", default = None, help = "store the --compare results as baseline file")
+    parser.add_option("--baseline", default = None, help = "compare the --compare results with a baseline file")
+    parser.add_option("--tolerance", type = "float", default = 0.2,
+                      help = "allowed fraction of throughput loss / p99 increase against the baseline [%default]")
+    options, args = parser.parse_args()
+    methods = parse_mix(options.mix)
+
+    print "%d clients, %.1f s, mix %s, payload %d bytes, %s connections" % (
+        options.concurrency, options.duration, options.mix, options.payload_size,
+        "keep-alive" if options.reuse else "new")
+    print_header()
+
+    if options.compare is None:
+        address = options.unix or (options.host, options.port)
+        generator = LoadGenerator(address, options.concurrency, options.duration,
+                                  options.warmup, methods, options.payload_size, options.reuse, options.timeout)
+        print_result(options.unix or "%s:%d" % address, generator.run())
+        sys.exit(0)
+
+    modes = [mode.strip() for mode in options.compare.split(",")]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("unknown mode %s" % mode)
+    results = compare(modes, options, methods)
+
+    settings = {"concurrency": options.concurrency, "duration": options.duration, "mix": options.mix,
+                "payload_size": options.payload_size, "reuse": options.reuse}
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent = 2, sort_keys = True,
+                      separators = (",", ": "))
+        print "baseline stored in %s" % options.save
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            print "WARNING: the baseline was measured with other settings: %s" % baseline["settings"]
+        regressions = check_baseline(results, baseline["results"], options.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            sys.exit(1)
+        print "no regressions against %s" % options.baseline
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+"""
+Pre-forking JSON-RPC server engine.
+
+A supervisor forks a fixed number of long-lived worker processes. Every
+worker binds its own listening socket to the same address with
+SO_REUSEPORT, so the kernel balances new connections over the workers and
+CPU-bound RPC-functions scale over the cores. Crashed workers are
+restarted; on SIGTERM the workers stop accepting connections and finish
+their current requests before exiting.
+"""
+
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import SocketServer
+
+import unixserver
+
+# missing in the socket module of Python 2, value for Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+class WorkerServer(SocketServer.ThreadingTCPServer):
+    """Server of a single worker process.
+
+    Connections are served by threads, the dispatcher is built once per
+    worker and shared by all connections. For a Unix domain socket (the
+    server_address is a path) the socket is not bound here, the worker
+    uses the socket of the PreforkServer instead.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    # seconds between checks for SIGTERM
+    timeout = 0.5
+
+    def __init__(self, server_address, RequestHandlerClass, dispatcher):
+        self.dispatcher = dispatcher
+        self.draining = False
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        bind = not unixserver.is_unix_address(server_address)
+        if not bind:
+            self.address_family = socket.AF_UNIX
+        SocketServer.ThreadingTCPServer.__init__(self, server_address, RequestHandlerClass, bind)
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        SocketServer.ThreadingTCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingTCPServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        SocketServer.ThreadingTCPServer.shutdown_request(self, request)
+
+    def drain(self, timeout):
+        """Stop accepting and wait until the open connections are finished.
+
+        The read side of every connection is shut down: idle keep-alive
+        connections end at once, busy ones after sending their reply.
+
+        :Returns: True if all connections finished within timeout seconds
+        """
+        self.server_close()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+        deadline = time.time() + timeout
+        while self.connections and time.time() < deadline:
+            time.sleep(0.05)
+        return not self.connections
+
+
+class PreforkServer:
+    """Supervisor of the worker processes.
+
+    SO_REUSEPORT does not apply to Unix domain sockets: for a socket path
+    the supervisor binds the (non-blocking) socket once and the workers
+    accept from the inherited socket.
+
+    :Variables:
+        - workers:       number of worker processes
+        - drain_timeout: seconds a worker may take to finish its connections
+    """
+    drain_timeout = 10
+    # signals of the supervisor passed on to all workers (e.g. SIGUSR1,
+    # which toggles profiling in the workers of test.py)
+    forward_signals = (signal.SIGUSR1,)
+    # minimal seconds between restarts of a worker that crashed right away
+    restart_delay = 1.0
+
+    def __init__(self, server_address, create_server, workers = None):
+        """init
+
+        :Parameters:
+            - server_address: (host, port) to listen on, or the path of a
+                              Unix domain socket
+            - create_server:  function(server_address) returning a
+                              WorkerServer, called in every worker
+            - workers:        number of workers, default the number of cores
+        """
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.server_address = server_address
+        self.create_server = create_server
+        self.workers = workers
+        self.pids = {}              # pid -> start time
+        self.listener = None        # socket shared by the workers (Unix domain)
+        self._running = False
+
+    def logfile(self, message):
+        print(message)
+
+    def serve_forever(self):
+        """Start the workers and restart them when they exit, until shutdown()."""
+        self._running = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.shutdown())
+        for signum in self.forward_signals:
+            signal.signal(signum, lambda signum, frame: self.forward(signum))
+        if unixserver.is_unix_address(self.server_address):
+            self.listener = unixserver.listen(self.server_address, 1024)
+            self.listener.setblocking(0)      # the workers compete for accept()
+        for i in range(self.workers):
+            self.spawn()
+
+        while self._running:
+            try:
+                pid, status = os.wait()
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.pids.pop(pid, None)
+            if started is None or not self._running:
+                continue
+            self.logfile("Worker %d exited (status %d), restarting" % (pid, status))
+            if time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            self.spawn()
+
+        self.stop_workers()
+        if self.listener is not None:
+            self.listener.close()
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+
+    def spawn(self):
+        """Fork a worker process."""
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.time()
+            return
+
+        status = 0
+        try:
+            self.run_worker()
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def run_worker(self):
+        """Main loop of a worker, serves until SIGTERM and drains."""
+        # Ctrl-C reaches the whole process group, the supervisor stops us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in self.forward_signals:
+            signal.signal(signum, signal.SIG_DFL)
+        server = self.create_server(self.server_address)
+        if self.listener is not None:
+            server.socket.close()
+            server.socket = self.listener
+
+        def drain(signum, frame):
+            server.draining = True
+        signal.signal(signal.SIGTERM, drain)
+
+        while not server.draining:
+            server.handle_request()
+        if not server.drain(self.drain_timeout):
+            self.logfile("Worker %d: connections left after drain timeout" % os.getpid())
+
+    def forward(self, signum):
+        """Send signal signum to all workers."""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop_workers(self):
+        """Send SIGTERM to the workers and wait for them, kill them after drain_timeout."""
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.drain_timeout + 1
+        while self.pids and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.ECHILD:
+                    break
+                continue
+            if pid:
+                self.pids.pop(pid, None)
+            else:
+                time.sleep(0.05)
+
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop serve_forever(), the workers are drained."""
+        self._running = False
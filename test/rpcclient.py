@@ -0,0 +1,395 @@
+#!/usr/bin/python
+
+"""
+JSON-RPC 1.0 client with a pool of keep-alive connections.
+
+A ServerProxy can be shared by threads, every call uses a connection of
+the pool exclusively and returns it for reuse afterwards:
+
+    proxy = rpcclient.ServerProxy(("127.0.0.1", 3000))
+    proxy.test.Test(7, 8)                               # 15
+    proxy.call("test.Test", [7, 8], timeout = 0.5)      # 15
+
+Several calls can be sent in one round-trip, as batch (one JSON array,
+one reply) or pipelined (back to back on one connection, the replies are
+matched by id). Both return the results in the order of the calls, with
+a RPCFault instance for every failed call:
+
+    proxy.batch([("test.Test", [1, 2]), ("test.Lookup", ["a"])])
+    proxy.pipeline([("test.Test", [1, 2]), ("test.Lookup", ["a"])])
+
+Errors of the server are raised as jsonrpc.RPCFault (or a derivate like
+RPCMethodNotFound), transport errors as jsonrpc.RPCTransportError and
+replies which do not arrive within the timeout as jsonrpc.RPCTimeoutError.
+"""
+
+import collections
+import itertools
+import socket
+import threading
+import time
+
+import jsonrpc
+import unixserver
+from jsonrpc import RPCFault, RPCTransportError, RPCTimeoutError
+
+
+class Connection:
+    """A keep-alive connection to the server.
+
+    :Variables:
+        - used:      number of exchanges on the connection
+        - last_used: time.time() of the last reply
+    """
+    # size of a single socket read
+    recv_size = 65536
+
+    def __init__(self, address, connect_timeout = None, framing = "json", max_frame_size = None):
+        """init: connect
+
+        :Parameters:
+            - address:         (host, port) or the path of a Unix domain socket
+            - connect_timeout: seconds, None to wait forever
+            - framing:         "json" or "netstring"
+        :Raises: RPCTimeoutError, RPCTransportError
+        """
+        self.address = address
+        self.decoder = jsonrpc.FRAMINGS[framing](max_frame_size)
+        self.frames = collections.deque()   # received, not yet returned replies
+        self.used = 0
+        self.last_used = time.time()
+        self.received = 0           # bytes received since the last send()
+        self.sock = None
+        try:
+            if unixserver.is_unix_address(address):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(connect_timeout)
+                self.sock.connect(address)
+            else:
+                self.sock = socket.create_connection(address, connect_timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.timeout:
+            self.close()
+            raise RPCTimeoutError("Connect to %s timed out." % (address,))
+        except socket.error, err:
+            self.close()
+            raise RPCTransportError("Connect to %s failed: %s" % (address, err))
+
+    def send(self, messages, deadline = None):
+        """Send serialized messages back to back.
+
+        :Parameters:
+            - deadline: time.time() until which to wait, None to wait forever
+        :Raises: RPCTimeoutError, RPCTransportError
+        """
+        self.used += 1
+        self.received = 0
+        self._settimeout(deadline)
+        try:
+            self.sock.sendall("".join([self.decoder.encode(message) for message in messages]))
+        except socket.timeout:
+            raise RPCTimeoutError("Send to %s timed out." % (self.address,))
+        except socket.error, err:
+            raise RPCTransportError("Send to %s failed: %s" % (self.address, err))
+
+    def receive(self, deadline = None):
+        """Return the next reply (serialized).
+
+        :Parameters:
+            - deadline: time.time() until which to wait, None to wait forever
+        :Raises: RPCTimeoutError, RPCTransportError (also if the server
+                 closed the connection or sent an invalid stream)
+        """
+        while not self.frames:
+            self._settimeout(deadline)
+            try:
+                data = self.sock.recv(self.recv_size)
+            except socket.timeout:
+                raise RPCTimeoutError("No reply from %s within the timeout." % (self.address,))
+            except socket.error, err:
+                raise RPCTransportError("Receive from %s failed: %s" % (self.address, err))
+            if not data:
+                raise RPCTransportError("Connection closed by %s." % (self.address,))
+            self.received += len(data)
+            try:
+                self.frames.extend(self.decoder.feed(data))
+            except RPCFault, err:
+                raise RPCTransportError("Invalid reply stream: %s" % str(err))
+        self.last_used = time.time()
+        return self.frames.popleft()
+
+    def _settimeout(self, deadline):
+        if deadline is None:
+            self.sock.settimeout(None)
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RPCTimeoutError("No reply from %s within the timeout." % (self.address,))
+        self.sock.settimeout(remaining)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive connections to one server.
+
+    At most size connections are open, acquire() waits for a free one.
+    The most recently used idle connection is reused first; connections
+    idle for more than max_idle seconds are closed, before the server
+    closes them (see the idle_timeout of the server).
+    """
+    def __init__(self, address, size = 8, connect_timeout = 5.0, max_idle = 25.0,
+                 framing = "json", max_frame_size = None):
+        """init
+
+        :Parameters:
+            - address:         (host, port) or the path of a Unix domain socket
+            - size:            maximum number of open connections
+            - connect_timeout: seconds, None to wait forever
+            - framing:         "json" or "netstring"
+            - max_frame_size:  maximum size of a reply, None for unlimited
+        """
+        self.address = address
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.max_idle = max_idle
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self._idle = []             # stack of idle Connections
+        self._open = 0
+        self._available = threading.Condition(threading.Lock())
+        self.closed = False
+        self.connects = 0
+
+    def acquire(self, deadline = None):
+        """Return a connection for exclusive use, connect if there is no idle one.
+
+        :Parameters:
+            - deadline: time.time() until which to wait, None to wait forever
+        :Raises: RPCTimeoutError, RPCTransportError (also if the pool is closed)
+        """
+        with self._available:
+            while True:
+                if self.closed:
+                    raise RPCTransportError("Connection pool of %s is closed." % (self.address,))
+                while self._idle:
+                    connection = self._idle.pop()
+                    if time.time() - connection.last_used < self.max_idle:
+                        return connection
+                    connection.close()
+                    self._open -= 1
+                if self._open < self.size:
+                    self._open += 1
+                    self.connects += 1
+                    break
+                if deadline is None:
+                    self._available.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RPCTimeoutError("No free connection to %s within the timeout." % (self.address,))
+                    self._available.wait(remaining)
+
+        connect_timeout = self.connect_timeout
+        if deadline is not None:
+            remaining = max(0.001, deadline - time.time())
+            connect_timeout = remaining if connect_timeout is None else min(connect_timeout, remaining)
+        try:
+            return Connection(self.address, connect_timeout, self.framing, self.max_frame_size)
+        except:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+
+    def release(self, connection):
+        """Return a connection after a completed exchange, for reuse."""
+        with self._available:
+            if not self.closed:
+                self._idle.append(connection)
+                self._available.notify()
+                return
+            self._open -= 1
+        connection.close()
+
+    def discard(self, connection):
+        """Close a connection which is broken or in an unknown state."""
+        connection.close()
+        with self._available:
+            self._open -= 1
+            self._available.notify()
+
+    def close(self):
+        """Close the idle connections, connections in use are closed on release."""
+        with self._available:
+            self.closed = True
+            self._available.notify_all()    # waiting acquire() calls fail
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """Return a dict with size, open and idle connections and connects."""
+        with self._available:
+            return {"size": self.size, "open": self._open, "idle": len(self._idle), "connects": self.connects}
+
+
+class _Method:
+    """Callable for proxy.name(*params), proxy.name.sub(...) calls name.sub."""
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Method(self._proxy, "%s.%s" % (self._name, name))
+
+    def __call__(self, *params):
+        return self._proxy.call(self._name, params)
+
+
+class ServerProxy:
+    """Client of a JSON-RPC server, see the module documentation.
+
+    :Variables:
+        - timeout:      default seconds to wait for a reply, None to wait forever
+        - send_timeout: send the timeout with every request, so the server
+                        drops requests it can not start in time
+        - retry:        a request which fails because the server closed a
+                        reused keep-alive connection before sending any
+                        reply is sent again on a new connection (once)
+    """
+    def __init__(self, address, pool_size = 8, timeout = 10.0, connect_timeout = 5.0, framing = "json",
+                 send_timeout = False, retry = True, max_idle = 25.0, serializer = None):
+        """init
+
+        :Parameters:
+            - address:    (host, port) or the path of a Unix domain socket
+            - pool_size:  maximum number of connections, i.e. of calls
+                          in progress at the same time
+            - serializer: the serializer, JsonRpc10 if omitted
+            - see ConnectionPool for the others
+        """
+        self.serializer = serializer or jsonrpc.JsonRpc10()
+        self.pool = ConnectionPool(address, pool_size, connect_timeout, max_idle, framing)
+        self.timeout = timeout
+        self.send_timeout = send_timeout
+        self.retry = retry
+        self._ids = itertools.count(1)     # next() is atomic
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Method(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connections, see ConnectionPool.close."""
+        self.pool.close()
+
+    def call(self, method, params = (), timeout = None):
+        """Call method and return its result.
+
+        :Parameters:
+            - params:  the parameters (list/tuple)
+            - timeout: seconds to wait for the reply, default self.timeout
+        :Raises: RPCFault (and derivates), RPCTransportError, RPCTimeoutError
+        """
+        timeout = self.timeout if timeout is None else timeout
+        id = next(self._ids)
+        reply = self._exchange([self._dumps_request(method, params, id, timeout)], 1, timeout)[0]
+        responses, batch = self.serializer.loads_batch_response(reply)
+        result, reply_id = responses[0]
+        if batch or reply_id not in (id, None):
+            raise RPCTransportError("Reply does not match the request.")
+        if isinstance(result, RPCFault):
+            raise result
+        return result
+
+    def batch(self, calls, timeout = None):
+        """Call several methods with one batch request.
+
+        :Parameters:
+            - calls:   list of (method, params)
+            - timeout: seconds to wait for the reply, default self.timeout
+        :Returns: list of the results, RPCFault instances for failed calls
+        :Raises:  RPCTransportError, RPCTimeoutError
+        """
+        if not calls:
+            return []
+        timeout = self.timeout if timeout is None else timeout
+        ids = [next(self._ids) for call in calls]
+        requests = [self._dumps_request(method, params, id, timeout) for (method, params), id in zip(calls, ids)]
+        reply = self._exchange(["[%s]" % ",".join(requests)], 1, timeout)[0]
+        responses, batch = self.serializer.loads_batch_response(reply)
+        if not batch:
+            # the batch was rejected as a whole
+            return [responses[0][0]] * len(calls)
+        return self._match(ids, responses)
+
+    def pipeline(self, calls, timeout = None):
+        """Call several methods, the requests are sent back to back on one
+        connection before the replies are read.
+
+        Unlike a batch, the server may reply to every call as soon as it is
+        done (see the pipeline threads of the server).
+
+        :Parameters: see batch
+        :Returns:    see batch
+        :Raises:     see batch
+        """
+        if not calls:
+            return []
+        timeout = self.timeout if timeout is None else timeout
+        ids = [next(self._ids) for call in calls]
+        requests = [self._dumps_request(method, params, id, timeout) for (method, params), id in zip(calls, ids)]
+        responses = []
+        for reply in self._exchange(requests, len(requests), timeout):
+            responses.extend(self.serializer.loads_batch_response(reply)[0])
+        return self._match(ids, responses)
+
+    def _dumps_request(self, method, params, id, timeout):
+        if not self.send_timeout:
+            timeout = None
+        return self.serializer.dumps_request(method, params, id, timeout)
+
+    def _match(self, ids, responses):
+        """Order the results of responses [(result, id), ...] like ids."""
+        results = dict((id, result) for result, id in responses)
+        return [results.get(id, jsonrpc.RPCInvalidRPC("Invalid Response, no reply to the request."))
+                for id in ids]
+
+    def _exchange(self, requests, replies, timeout):
+        """Send requests on a connection of the pool and receive replies replies."""
+        deadline = None if timeout is None else time.time() + timeout
+        attempts = 2 if self.retry else 1
+        for attempt in range(attempts):
+            connection = self.pool.acquire(deadline)
+            reused = connection.used > 0
+            try:
+                connection.send(requests, deadline)
+                received = [connection.receive(deadline) for i in range(replies)]
+            except RPCTimeoutError:
+                self.pool.discard(connection)   # late replies would be read by the next call
+                raise
+            except RPCTransportError:
+                self.pool.discard(connection)
+                # the server closed the idle connection before reading the requests
+                if reused and not connection.received and attempt < attempts - 1:
+                    continue
+                raise
+            except:
+                self.pool.discard(connection)
+                raise
+            self.pool.release(connection)
+            return received
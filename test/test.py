@@ -1,8 +1,100 @@
 #!/usr/bin/python
 
+import sys
+import time
+import signal
+import socket
+import optparse
+import threading
 import SocketServer
 import jsonrpc
 import apiTest
+import asyncserver
+import epollserver
+import gateway
+import prefork
+import unixserver
+from jsonrpc import RPCFault
+
+# set apiModel
+test  = apiTest.apiTest()
+
+def create_dispatcher(batch_threads = 0, pool = None, codec = None, stats = True, logger = None,
+                      process_pool = None, profiler = None):
+    """Create the dispatcher serving the api's (hardcoded for now).
+
+    Called once per process at startup, the registry is frozen afterwards.
+
+    :Parameters:
+        - batch_threads: number of threads executing the entries of a
+                         batch in parallel, 0 to execute them sequentially
+        - pool:          WorkerPool of the server, its stats are served
+                         as system.pool
+        - codec:         name of the json codec, default the fastest
+        - stats:         instrument the dispatcher, the statistics are
+                         served as system.stats
+        - logger:        jsonrpc.AsyncLogger, None to print synchronously
+        - process_pool:  jsonrpc.ProcessPool executing the CPU-bound
+                         functions, None to execute them in-process. Its
+                         stats are served as system.processes
+        - profiler:      jsonrpc.Profiler, served as system.profile.*
+    """
+    batch_pool = None
+    if batch_threads:
+        batch_pool = jsonrpc.WorkerPool(batch_threads, batch_threads * 64)
+    data_serializer = jsonrpc.JsonRpc10(codec = jsonrpc.get_codec(codec))
+    dispatcher = jsonrpc.Dispatcher(data_serializer, batch_pool = batch_pool,
+                                    stats = jsonrpc.Stats() if stats else None, logger = logger,
+                                    process_pool = process_pool, profiler = profiler)
+    dispatcher.register_instance(test, name = "test",
+                                 cache = {"Lookup": jsonrpc.ResultCache(ttl = 10, max_entries = 10000)},
+                                 coalesce = ("Lookup",), cpu_bound = ("Primes",),
+                                 timeout = {"Primes": 10, "Sleep": 60})
+    if pool is not None:
+        pool.logger = logger
+        dispatcher.register_function(pool.stats, name = "system.pool")
+    if process_pool is not None:
+        dispatcher.register_function(process_pool.stats, name = "system.processes")
+    return dispatcher.freeze()
+
+def create_gateway(routes, timeout = 10.0, batch_threads = 0, pool = None, codec = None, stats = True,
+                   logger = None, profiler = None):
+    """Create the gateway forwarding the requests to backend servers by
+    method prefix, instead of serving the api's.
+
+    :Parameters:
+        - routes:  list of "prefix=address,address,...", an address is
+                   host:port or the path of a Unix domain socket
+        - timeout: seconds to wait for a backend
+        - see create_dispatcher for the others
+    """
+    backends = {}
+    for route in routes:
+        prefix, _, addresses = route.partition("=")
+        backends.setdefault(prefix.strip().rstrip("."), []).extend(
+            gateway.parse_address(address.strip()) for address in addresses.split(","))
+    batch_pool = None
+    if batch_threads:
+        batch_pool = jsonrpc.WorkerPool(batch_threads, batch_threads * 64)
+    data_serializer = jsonrpc.JsonRpc10(codec = jsonrpc.get_codec(codec))
+    dispatcher = gateway.Gateway(backends, timeout, data_serializer = data_serializer, batch_pool = batch_pool,
+                                 stats = jsonrpc.Stats() if stats else None, logger = logger,
+                                 profiler = profiler)
+    if pool is not None:
+        pool.logger = logger
+        dispatcher.register_function(pool.stats, name = "system.pool")
+    return dispatcher.freeze()
+
+def create_pipeline_pool(threads, shed_target = None, logger = None):
+    """Create the pool executing pipelined requests, None if threads is 0.
+
+    :Parameters:
+        - shed_target, logger: see jsonrpc.WorkerPool
+    """
+    if not threads:
+        return None
+    return jsonrpc.WorkerPool(threads, threads * Handler.max_pipeline, shed_target, logger)
+
 
 class Handler(SocketServer.BaseRequestHandler):
     """JSON-RPC-server.
@@ -13,141 +105,272 @@ class Handler(SocketServer.BaseRequestHandler):
         - logging/loglevels?
     """
 
-    # set apiModel
-    test  = apiTest.apiTest()
+    # seconds an idle keep-alive connection is kept open
+    idle_timeout = 30
+    # size of a single socket read
+    recv_size = 65536
+    # maximum size of a request in bytes, None for unlimited
+    max_frame_size = 16 * 1024 * 1024
+    # message framing: "auto" (negotiated by the client), "json" or "netstring"
+    framing = "auto"
+    # maximum number of pipelined requests in progress per connection
+    max_pipeline = 64
 
     def setup(self):
         SocketServer.BaseRequestHandler.setup(self)
 
-        self.__data_serializer = jsonrpc.JsonRpc10()
-
-        self.funcs = {}
-        self.register_instance(self.test, name = "test")
+        # built once at startup, shared by all connections
+        self.dispatcher = self.server.dispatcher
 
 
     def logfile(self, message):
-        print(message)
+        self.dispatcher.logfile(message)
 
-    def register_instance(self, myinst, name = None):
-        """Add all functions of a class-instance to the RPC-services.
+    def dispatch(self, rpcstr, received = None):
+        """Handle a RPC-Request, see jsonrpc.Dispatcher.dispatch."""
+        return self.dispatcher.dispatch(rpcstr, received = received)
 
-        All entries of the instance which do not begin with '_' are added.
 
-        :Parameters:
-            - myinst: class-instance containing the functions
-            - name:   | hierarchical prefix.
-                      | If omitted, the functions are added directly.
-                      | If given, the functions are added as "name.function".
-        :TODO:
-            - only add functions and omit attributes?
-            - improve hierarchy?
-        """
-        for e in dir(myinst):
-            if e[0][0] != "_":
-                if name is None:
-                    self.register_function(getattr(myinst, e))
-                else:
-                    self.register_function(getattr(myinst, e), name="%s.%s" % (name, e))
-
-    def register_function(self, function, name = None):
-        """Add a function to the RPC-services.
-
-        :Parameters:
-            - function: function to add
-            - name:     RPC-name for the function. If omitted/None, the original
-                        name of the function is used.
+    def handle(self):
         """
-        if name is None:
-            self.funcs[function.__name__] = function
-        else:
-            self.funcs[name] = function
-
+        Handle data transfer and dispatching
 
-    def dispatch(self, rpcstr):
-        """Handle a RPC-Request.
+        The connection is kept open (keep-alive) and serves requests until
+        the client closes it or no request arrived within idle_timeout seconds.
+        The received stream is split into requests by a frame decoder, so
+        requests may be larger than one read and may be sent back to back.
+        Replies are framed the same way as the requests.
 
-        :Parameters:
-            - rpcstr: the received rpc-string
-        :Returns: the data to send back or None if nothing should be sent back
-        :Raises:  RPCFault (and maybe others)
+        If the server has a pipeline_pool, the requests of a connection are
+        executed concurrently and every reply is sent as soon as it is
+        ready, so replies may arrive out of order (matched by id). At most
+        max_pipeline requests per connection are in progress.
         """
-        notification = False
+        self.request.settimeout(self.idle_timeout)
+        self.send_lock = threading.Lock()
+        pool = getattr(self.server, "pipeline_pool", None)
+        self.inflight = threading.Semaphore(self.max_pipeline)
+
+        chunk = bytearray(self.recv_size)
+        view = memoryview(chunk)
+        self.decoder = jsonrpc.FRAMINGS[self.framing](self.max_frame_size)
+        while True:
+            try:
+                n = self.request.recv_into(chunk)
+            except socket.timeout:
+                break
+            except socket.error:
+                break
+            if not n:           # closed by client
+                break
+            received = time.time()
+
+            try:
+                frames = self.decoder.feed(view[:n])
+            except RPCFault, err:
+                # the stream can not be resynchronized, answer and hang up
+                self.logfile("Invalid stream: %s" % str(err))
+                self.send(self.dispatcher.data_serializer.dumps_error(err, id = None))
+                break
+
+            for data in frames:
+                self.dispatcher.log_payload("Request: ", data)
+                if pool is None:
+                    if not self.send(self.dispatch(data, received)):
+                        return
+                    continue
+
+                self.inflight.acquire()
+                try:
+                    pool.submit(self.pipeline_job, data, received)
+                except RPCFault, err:
+                    self.inflight.release()
+                    if not self.send(self.dispatcher.error_reply(data, err)):
+                        return
+
+        # wait for the requests in progress
+        if pool is not None:
+            for i in range(self.max_pipeline):
+                self.inflight.acquire()
+
+    def pipeline_job(self, data, received):
+        """Dispatch a pipelined request in a thread of the pipeline_pool."""
         try:
-            req = self.__data_serializer.loads_request(rpcstr)
-            if len(req) == 2:       #notification
-                method, params = req
-                notification = True
-            else:                   #request
-                method, params, id = req
-
-        except RPCFault, err:
-            return self.__data_serializer.dumps_error(err, id = None)
-
-        except Exception, err:
-            self.logfile("%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)))
-            exc_type, exc_value, exc_traceback = sys.exc_info();
-            self.logfile(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-            return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id = None)
-
-        if method not in self.funcs:
-            if notification:
-                return None
-            return self.__data_serializer.dumps_error( RPCFault(METHOD_NOT_FOUND, ERROR_MESSAGE[METHOD_NOT_FOUND]), id )
-
+            reply = self.dispatcher.dispatch(data, callback = self.pipeline_reply, received = received)
+        except Exception:
+            # pipeline_reply must run, it releases the inflight permit
+            self.dispatcher.log_exception(sys.exc_info())
+            reply = self.dispatcher.error_reply(data, jsonrpc.RPCInternalError())
+        if not isinstance(reply, jsonrpc.AsyncResult):
+            self.pipeline_reply(reply)
+
+    def pipeline_reply(self, reply):
+        """Send the reply of a pipelined request."""
         try:
-            if isinstance(params, dict):
-                result = self.funcs[method](**params)
-            else:
-                result = self.funcs[method](*params)
-
-        except RPCFault, err:
-            if notification:
-                return None
-            return self.__data_serializer.dumps_error(err, id = None)
-
-        except Exception, err:
-            if notification:
-                return None
-            self.logfile("%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)))
-            exc_type, exc_value, exc_traceback = sys.exc_info();
-            self.logfile(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-            return self.__data_serializer.dumps_error(RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id)
-
-        if notification:
-            return None
-
+            self.send(reply)
+        finally:
+            self.inflight.release()
+
+    def send(self, reply):
+        """Send a reply (None sends nothing), returns False if the connection is broken."""
+        if reply is None:
+            return True
         try:
-            return self.__data_serializer.dumps_response(result, id)
+            if isinstance(reply, jsonrpc.StreamedReply):
+                with self.send_lock:
+                    for chunk in self.decoder.encode_stream(reply):
+                        self.request.sendall(chunk)
+                self.dispatcher.log_payload("Reply: ", "(streamed, %d bytes)" % reply.size)
+                return True
+            self.dispatcher.log_payload("Reply: ", reply)
+            with self.send_lock:
+                self.request.sendall(self.decoder.encode(reply))
+        except socket.error:
+            return False
+        return True
+
+class ThreadingServer(SocketServer.ThreadingTCPServer):
+    """Thread per (keep-alive) connection."""
+    allow_reuse_address = True
+    daemon_threads = True
 
-        except Exception, err:
-            self.logfile("%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)))
-            exc_type, exc_value, exc_traceback = sys.exc_info();
-            self.logfile(repr(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-            return self.__data_serializer.dumps_error(RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id)
-
-
-    def handle(self):
-        """
-        Handle data transfer and dispatching
-        """
-        data = self.request.recv(4096).strip()
-        self.logfile("Request: " + data)
-        reply = self.dispatch(data)
-        self.logfile("Reply: " + reply)
-        self.request.sendall(reply)
 
 if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", default = "127.0.0.1", help = "listen address [%default]")
+    parser.add_option("-p", "--port", type = "int", default = 3000, help = "listen port [%default]")
+    parser.add_option("-u", "--unix", default = None, metavar = "PATH",
+                      help = "listen on the Unix domain socket PATH instead of TCP")
+    parser.add_option("--unix-mode", default = "0660",
+                      help = "permissions (octal) of the Unix domain socket file [%default]")
+    parser.add_option("-m", "--mode", default = "thread",
+                      choices = ["tcp", "fork", "thread", "async", "pool", "prefork", "epoll"],
+                      help = "server engine: tcp, fork, thread, async, pool, prefork or epoll [%default]")
+    parser.add_option("-w", "--workers", type = "int", default = None,
+                      help = "number of prefork workers [number of cores]")
+    parser.add_option("-t", "--threads", type = "int", default = 16,
+                      help = "number of pool threads, with epoll 0 executes the requests in the loop [%default]")
+    parser.add_option("-q", "--queue-size", type = "int", default = 256,
+                      help = "maximum number of requests waiting for a pool thread [%default]")
+    parser.add_option("--shed-target", type = "float", default = 0,
+                      help = "milliseconds of queueing delay for a pool or pipeline thread above which "
+                             "requests are rejected (load shedding), 0 to reject only when the queue is full [%default]")
+    parser.add_option("-P", "--pipeline-threads", type = "int", default = 0,
+                      help = "threads executing pipelined requests of tcp, fork, thread and "
+                             "prefork connections concurrently (with fork in each connection process), "
+                             "0 to reply in order [%default]")
+    parser.add_option("-b", "--batch-threads", type = "int", default = 0,
+                      help = "threads executing batch entries in parallel, 0 for sequential [%default]")
+    parser.add_option("-x", "--processes", type = "int", default = 0,
+                      help = "worker processes executing the CPU-bound methods (per prefork worker), "
+                             "0 to execute them in-process [%default]")
+    parser.add_option("--process-timeout", type = "float", default = 30,
+                      help = "seconds a CPU-bound method may take [%default]")
+    parser.add_option("-r", "--route", action = "append", default = [], metavar = "PREFIX=ADDRESS,...",
+                      help = "run as gateway: forward the methods PREFIX.* to the backend servers ADDRESS "
+                             "(host:port or socket path), repeat for more prefixes; an empty PREFIX is the default route")
+    parser.add_option("--gateway-timeout", type = "float", default = 10.0,
+                      help = "seconds the gateway waits for a backend [%default]")
+    parser.add_option("--idle-timeout", type = "float", default = 30,
+                      help = "seconds an idle keep-alive connection is kept open [%default]")
+    parser.add_option("--max-connections", type = "int", default = 10000,
+                      help = "maximum number of open connections of the epoll engine [%default]")
+    parser.add_option("-c", "--codec", default = None, choices = sorted(jsonrpc.CODECS),
+                      help = "json codec: %s [fastest]" % ", ".join(sorted(jsonrpc.CODECS)))
+    parser.add_option("--no-stats", dest = "stats", action = "store_false", default = True,
+                      help = "do not collect the statistics served as system.stats")
+    parser.add_option("--profile-dir", default = "/tmp/jsonrpc-profile",
+                      help = "directory of the profiles, profiling is started and stopped by SIGUSR1 "
+                             "or system.profile.start/stop [%default]")
+    parser.add_option("--profile-sample", type = "float", default = 0.01,
+                      help = "fraction of the requests profiled after SIGUSR1 [%default]")
+    parser.add_option("--log-sample", type = "float", default = 1.0,
+                      help = "fraction of the requests and replies which are logged [%default]")
+    parser.add_option("--log-max-payload", type = "int", default = 1024,
+                      help = "requests and replies are logged truncated to this size [%default]")
+    options, args = parser.parse_args()
+    if options.route and (options.mode == "async" or options.mode == "epoll" and not options.threads):
+        parser.error("the gateway waits for the backends in the serving thread, use another mode than async or epoll without threads")
+    address = (options.host, options.port)
+    Handler.idle_timeout = asyncserver.AsyncServer.idle_timeout = options.idle_timeout
+    epollserver.EpollServer.idle_timeout = options.idle_timeout
+    epollserver.EpollServer.max_connections = options.max_connections
+    shed_target = options.shed_target / 1000.0 or None
+    if options.unix:
+        address = options.unix
+        unixserver.SOCKET_MODE = int(options.unix_mode, 8)
+
+    def dispatcher(pool = None):
+        # called in every prefork worker, the logger thread does not survive fork()
+        logger = jsonrpc.AsyncLogger(sample_rate = options.log_sample, max_payload = options.log_max_payload)
+        profiler = jsonrpc.Profiler(options.profile_dir)
+        # the handler may interrupt a thread holding the profiler, toggle in another one
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+            target = profiler.toggle, args = (options.profile_sample,)).start())
+        if options.route:
+            return create_gateway(options.route, options.gateway_timeout, options.batch_threads, pool,
+                                  options.codec, options.stats, logger, profiler)
+        process_pool = None
+        if options.processes:
+            process_pool = jsonrpc.ProcessPool(options.processes, options.process_timeout)
+        return create_dispatcher(options.batch_threads, pool, options.codec, options.stats, logger, process_pool,
+                                 profiler)
+
     # Welcome message
     print "Starting test server.."
 
+    # created before the listening socket, which the processes of the
+    # process pool must not inherit
+    if options.mode in ("tcp", "fork", "thread"):
+        server_dispatcher = dispatcher()
+
     # select one of these to create the server of your desires / nightmares
-    server = SocketServer.TCPServer(("127.0.0.1", 3000), Handler)
-    #server = SocketServer.ForkingTCPServer(("127.0.0.1", 3000), Handler)
-    #server = SocketServer.ThreadingTCPServer(("apiSettings.apiListenAddr127.0.0.1", 3000), Handler)
+    # (with keep-alive connections TCPServer serves only one client at a time)
+    if options.mode == "tcp":
+        if options.unix:
+            server = unixserver.UnixServer(address, Handler)
+        else:
+            server = SocketServer.TCPServer(address, Handler)
+    elif options.mode == "fork":
+        if options.unix:
+            server = unixserver.ForkingUnixServer(address, Handler)
+        else:
+            server = SocketServer.ForkingTCPServer(address, Handler)
+    elif options.mode == "thread":
+        if options.unix:
+            server = unixserver.ThreadingUnixServer(address, Handler)
+        else:
+            server = ThreadingServer(address, Handler)
+    elif options.mode == "async":
+        server = asyncserver.AsyncServer(address, dispatcher())
+    elif options.mode == "pool":
+        # event loop for the I/O, bounded thread pool for the requests
+        pool = jsonrpc.WorkerPool(options.threads, options.queue_size, shed_target)
+        server = asyncserver.AsyncServer(address, dispatcher(pool), pool = pool)
+    elif options.mode == "epoll":
+        # one loop multiplexing many idle keep-alive connections
+        pool = None
+        if options.threads:
+            pool = jsonrpc.WorkerPool(options.threads, options.queue_size, shed_target)
+        server = epollserver.EpollServer(address, dispatcher(pool), pool = pool)
+    else:
+        def create_worker(address):
+            worker = prefork.WorkerServer(address, Handler, dispatcher())
+            worker.pipeline_pool = create_pipeline_pool(options.pipeline_threads, shed_target,
+                                                        worker.dispatcher.logger)
+            return worker
+        server = prefork.PreforkServer(address, create_worker, workers = options.workers)
+
+    if isinstance(server, SocketServer.TCPServer):
+        server.dispatcher = server_dispatcher
+        server.pipeline_pool = create_pipeline_pool(options.pipeline_threads, shed_target,
+                                                    server_dispatcher.logger)
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print "Interrupt received, quiting test server.."
         server.shutdown()
+        if isinstance(server, SocketServer.TCPServer):
+            server.server_close()
         exit()
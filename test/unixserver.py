@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+"""
+Unix domain socket listeners for the JSON-RPC server engines.
+
+Clients on the same host (e.g. PHP-FPM workers) can connect to a socket
+file instead of TCP loopback, which skips the TCP stack for every call.
+The server address is then the path of the socket file instead of a
+(host, port) tuple.
+"""
+
+import errno
+import os
+import socket
+import stat
+import SocketServer
+
+# default permissions of the socket file, clients need write permission
+# to connect
+SOCKET_MODE = 0660
+
+
+def is_unix_address(server_address):
+    """True if server_address is the path of a Unix domain socket."""
+    return isinstance(server_address, basestring)
+
+
+def remove_stale(path):
+    """Remove the socket file left by a previous server.
+
+    :Raises: OSError if path exists and is not a socket
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError, err:
+        if err.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, "Not a socket: %s" % path)
+    os.unlink(path)
+
+
+def listen(path, backlog, mode = None):
+    """Return a listening Unix domain socket bound to path.
+
+    :Parameters:
+        - mode: permissions of the socket file, default SOCKET_MODE
+    """
+    if mode is None:
+        mode = SOCKET_MODE
+    remove_stale(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+class UnixServerMixIn:
+    """SocketServer listening on a Unix domain socket.
+
+    The socket file is created with socket_mode (default SOCKET_MODE) and
+    removed by server_close() of the process which created it (not by
+    forked children).
+    """
+    address_family = socket.AF_UNIX
+    socket_mode = None
+
+    def server_bind(self):
+        remove_stale(self.server_address)
+        SocketServer.TCPServer.server_bind(self)
+        os.chmod(self.server_address, SOCKET_MODE if self.socket_mode is None else self.socket_mode)
+        self.owner_pid = os.getpid()
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        if getattr(self, "owner_pid", None) == os.getpid():
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+
+
+class UnixServer(UnixServerMixIn, SocketServer.TCPServer):
+    """Serves one connection at a time."""
+
+
+class ForkingUnixServer(SocketServer.ForkingMixIn, UnixServer):
+    """Process per connection."""
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, UnixServer):
+    """Thread per (keep-alive) connection."""
+    daemon_threads = True